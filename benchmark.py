@@ -0,0 +1,384 @@
+"""Замеры производительности прайса на синтетических данных, без поставщика и Google Sheets.
+Запуск: python benchmark.py --rows 20000 - прогон всех этапов; python benchmark.py --trees - сравнение разбора групп."""
+import argparse
+import collections
+import hashlib
+import http.server
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+import openpyxl
+
+from pricelist import (FileFingerprint, GoogleSpreadsheetEditor, Header, Item, ItemGroup, PriceDownloader, PriceList,
+                       RateLimiter, RunStats, SnapshotStore, UPLOAD_WORKERS, iter_xlsx_rows)
+
+BRANDS = ["Xiaomi", "Redmi", "iPhone", "Huawei", "Samsung", "Realme", "Meizu", "Nokia", "ZTE", "SONY",
+          "LENOVO", "onePlus", "Б/У", "SSD", "Acer", "Asus"]
+HEADER_ROW = {1: "Номенклатура", 2: "Остаток", 3: "Розница", 4: "Опт"}
+
+
+def synthetic_rows(row_count: int, depth=3, seed=1, brands=BRANDS) -> list:
+    """Генерирует ряды прайса вида tuple(номер ряда, уровень группировки, {номер колонки: значение}).
+    Группы вложены до depth уровней, в конце каждой ветки - товары с названиями из brands."""
+    rnd = random.Random(seed)
+    rows = []
+
+    def add_group(level):
+        rows.append((len(rows) + 3, level, {1: f"Группа {len(rows)}"}))
+        for _ in range(rnd.randint(1, 4)):
+            if len(rows) >= row_count:
+                return
+            if level + 1 < depth and rnd.random() < 0.5:
+                add_group(level + 1)
+            else:
+                for _ in range(rnd.randint(1, 20)):
+                    if len(rows) >= row_count:
+                        return
+                    rows.append((len(rows) + 3, level + 1, {1: f"{rnd.choice(brands)} деталь {len(rows)}",
+                                                            2: rnd.randint(0, 50),
+                                                            3: rnd.randint(100, 9000),
+                                                            4: rnd.randint(100, 9000)}))
+
+    while len(rows) < row_count:
+        add_group(0)
+    return rows
+
+
+def synthetic_price_list(rows: list) -> io.BytesIO:
+    """Собирает xlsx в формате поставщика: в 1-2 рядах заголовок, дальше группы и товары с уровнями группировки."""
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append([HEADER_ROW[column] for column in sorted(HEADER_ROW)])
+    sheet.append([None, None, "Цена", "Цена"])
+    for row_number, level, values in rows:
+        sheet.append([values.get(column) for column in sorted(HEADER_ROW)])
+        sheet.row_dimensions[row_number].outline_level = level
+    result = io.BytesIO()
+    workbook.save(result)
+    result.seek(0)
+    return result
+
+
+def changed_rows(rows: list, count=1, seed=2) -> list:
+    """Копия рядов, в которой у count товаров поменялась розничная цена."""
+    rnd = random.Random(seed)
+    result = list(rows)
+    items = [i for i in range(len(rows)) if 3 in rows[i][2]]
+    for i in rnd.sample(items, min(count, len(items))):
+        row_number, level, values = result[i]
+        result[i] = (row_number, level, {**values, 3: values[3] + 1})
+    return result
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, sheet_id: int, title: str):
+        self._spreadsheet = spreadsheet
+        self.id = sheet_id
+        self.title = title
+
+    def update_index(self, index):
+        self._spreadsheet.record('update_index')
+        sheets = self._spreadsheet.sheets
+        sheets.insert(index, sheets.pop(sheets.index(self)))
+
+    def update_title(self, title):
+        self._spreadsheet.record('update_title')
+        self.title = title
+
+    def batch_update(self, data, **kwargs):
+        self._spreadsheet.record('values_batch_update', data)
+
+
+class FakeSpreadsheet:
+    """Заменитель gspread.Spreadsheet: ничего не отправляет, считает вызовы API и байты запросов.
+    latency - сколько секунд "идет" каждый вызов, чтобы изображать сеть."""
+
+    def __init__(self, sheet_count=15, latency=0.0):
+        self.id = 'benchmark'
+        self.sheets = [FakeWorksheet(self, 1000 + i, str(i)) for i in range(sheet_count)]
+        self.calls = collections.Counter()
+        self.payload_bytes = collections.Counter()
+        self._latency = latency
+        self._lock = threading.Lock()
+
+    def record(self, name, payload=None):
+        size = len(json.dumps(payload)) if payload is not None else 0  # как отправит requests
+        with self._lock:
+            self.calls[name] += 1
+            self.payload_bytes[name] += size
+        if self._latency:
+            time.sleep(self._latency)
+
+    def worksheets(self):
+        self.record('fetch_sheet_metadata')
+        return list(self.sheets)
+
+    def worksheet(self, title):
+        self.record('fetch_sheet_metadata')
+        return next(sheet for sheet in self.sheets if sheet.title == title)
+
+    def get_worksheet(self, index):
+        self.record('fetch_sheet_metadata')
+        return self.sheets[index]
+
+    def add_worksheet(self, title, rows, cols):
+        self.record('add_worksheet')
+        self.sheets.append(FakeWorksheet(self, max([999] + [sheet.id for sheet in self.sheets]) + 1, title))
+        return self.sheets[-1]
+
+    def del_worksheet(self, worksheet):
+        self.record('del_worksheet')
+        self.sheets.remove(worksheet)
+
+    def batch_update(self, body):
+        self.record('batch_update', body)
+        return {}
+
+    def values_batch_update(self, params=None, body=None):
+        self.record('values_batch_update', body)
+        return {}
+
+
+class _PriceListHandler(http.server.BaseHTTPRequestHandler):
+    """Отдает прайс, как сервер поставщика: ETag, 304, докачка Range с проверкой If-Range.
+    validators=False - сервер без ETag. cut_after - один раз оборвать ответ после стольких байт тела,
+    body_after_cut - файл, который сервер отдает после обрыва, как будто прайс обновили посреди скачивания.
+    ranges - заголовки Range полученных запросов."""
+    body = b''
+    validators = True
+    cut_after = None
+    body_after_cut = None
+    ranges = []
+
+    def do_GET(self):
+        handler = type(self)
+        etag = f'"{hashlib.sha1(handler.body).hexdigest()}"'
+        if handler.validators and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        handler.ranges.append(self.headers.get('Range'))
+        # без If-Range или с ETag текущего файла отдаем кусок, иначе - файл целиком
+        if self.headers.get('Range') and self.headers.get('If-Range') in (None, etag):
+            start = int(self.headers['Range'][len('bytes='):].partition('-')[0])
+        body = handler.body[start:]
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header('Content-Range', f'bytes {start}-{len(handler.body) - 1}/{len(handler.body)}')
+        if handler.validators:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if handler.cut_after is not None and handler.cut_after < len(body):
+            self.wfile.write(body[:handler.cut_after])
+            self.close_connection = True
+            handler.cut_after = None
+            if handler.body_after_cut is not None:
+                handler.body, handler.body_after_cut = handler.body_after_cut, None
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def legacy_parse_groups(header: Header, rows: list) -> ItemGroup:
+    """Прежний разбор: рекурсивный splitter, cleanup и _group_maker."""
+
+    def cleanup(x: list):
+        result = []
+        for i in x:
+            if type(i) is list:
+                result.append(cleanup(i))
+            else:
+                result.append(i[1])
+        return result
+
+    def splitter(x: list, base=0):
+        result = []
+        if x[0][0] < base:
+            result.append(x[0])
+        if len(set([a[0] for a in x[1:]])) == 1:
+            result.append(x[1:])
+            return result
+        for i in range(len(x)):
+            if x[i][0] == base:
+                for y in range(i + 1, len(x)):
+                    if x[y][0] == base:
+                        result.append(splitter(x[i:y], base + 1))
+                        break
+                else:
+                    result.append(splitter(x[i:], base + 1))
+        return result
+
+    def group_maker(row_list: list, parent=None) -> ItemGroup:
+        new_group = ItemGroup()
+        if parent is not None:
+            new_group.set_parent(parent)
+        for row in range(len(row_list)):
+            if row == 0:
+                new_group.set_header(values.get(row_list[row], {}))
+                continue
+            if any(type(x) == list for x in row_list[row]):
+                new_group.add_child(group_maker(row_list[row], new_group))
+            else:
+                for item in row_list[row]:
+                    new_group.add_child(Item(values[item], header))
+        return new_group
+
+    values = {row_number: row_values for row_number, _, row_values in rows}
+    values[1] = HEADER_ROW
+    groups = cleanup(splitter([(level, row_number) for row_number, level, _ in rows]))
+    groups.insert(0, 1)
+    return group_maker(groups)
+
+
+def stack_parse_groups(header: Header, rows: list) -> ItemGroup:
+    return ItemGroup.from_rows(header, HEADER_ROW, iter(rows))
+
+
+def count_nodes(group: ItemGroup) -> int:
+    return sum(1 + (count_nodes(child) if type(child) == ItemGroup else 0) for child in group)
+
+
+def check_interrupted_download(url: str, folder: str, body: bytes, validators: bool, changed_body=None) -> list:
+    """Обрывает скачивание body на середине и проверяет, что PriceDownloader собрал файл, который сервер отдает
+    после обрыва: докачал тот же или скачал заново смененный. Возвращает заголовки Range запросов."""
+    _PriceListHandler.body, _PriceListHandler.validators = body, validators
+    _PriceListHandler.cut_after, _PriceListHandler.body_after_cut = len(body) // 2, changed_body
+    _PriceListHandler.ranges = []
+    downloader = PriceDownloader(url, os.path.join(folder, 'cut.xlsx'), os.path.join(folder, 'cut.json'))
+    with downloader.fetch(conditional=False) as downloaded:
+        assert downloaded.read() == (changed_body if changed_body is not None else body), "download stitched"
+    return _PriceListHandler.ranges
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def timed_send(price_list: PriceList, editor: GoogleSpreadsheetEditor, **kwargs) -> tuple:
+    """send_pages с разбивкой: общее время, сборка листов (сумма этапов 'sheet ...' из RunStats) и отправка
+    (сумма времени в editor.send). Листы собираются и отправляются одновременно, поэтому сборка и отправка
+    сложены по потокам и вместе могут быть больше общего времени."""
+    RunStats().reset()
+    uploads = []
+    send = editor.send
+
+    def timed_upload(sheet_index):
+        seconds, calls = timed(send, sheet_index)
+        uploads.append(seconds)
+        return calls
+
+    editor.send = timed_upload
+    try:
+        total, _ = timed(lambda: price_list.send_pages(editor, **kwargs))
+    finally:
+        del editor.send
+    compose = sum(stage['wall'] for name, stage in RunStats().as_dict()['stages'].items() if name.startswith('sheet '))
+    return total, compose, sum(uploads)
+
+
+def bench_pipeline(row_count=20_000, depth=3, latency=0.0, changed=10):
+    """Прогоняет все этапы cron-запуска на синтетическом прайсе и печатает время каждого этапа и нагрузку на API."""
+    log = logging.getLogger('benchmark')
+    rows = synthetic_rows(row_count, depth)
+    saved = synthetic_price_list(rows)
+    updated = synthetic_price_list(changed_rows(rows, changed))
+    stages = collections.OrderedDict()
+
+    folder = tempfile.mkdtemp()
+    _PriceListHandler.body = updated.getvalue()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _PriceListHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    downloader = PriceDownloader(f'http://127.0.0.1:{server.server_port}/price.xlsx',
+                                 os.path.join(folder, 'price.xlsx'), os.path.join(folder, 'validators.json'))
+    stages['download'], downloaded = timed(downloader.fetch)
+    downloaded.close()
+    downloader.save_validators()
+    stages['download (304)'], _ = timed(downloader.fetch)
+    url = f'http://127.0.0.1:{server.server_port}/price.xlsx'
+    body, changed_body = updated.getvalue(), saved.getvalue()
+    # обрыв на середине: тот же файл докачивается, смененный или без ETag - скачивается заново
+    resumes = {'same file': check_interrupted_download(url, folder, body, True),
+               'changed file': check_interrupted_download(url, folder, body, True, changed_body),
+               'no validators': check_interrupted_download(url, folder, body, False, changed_body)}
+    server.shutdown()
+
+    fingerprint = FileFingerprint.of(saved)
+    stages['compare (same rows)'], _ = timed(fingerprint.matches, synthetic_price_list(rows))
+    stages['compare (changed)'], _ = timed(fingerprint.matches, updated)
+
+    price_list = PriceList(log, updated)
+    stages['parse'], groups = timed(price_list._parse_groups, updated)
+    stages['pages'], _ = timed(price_list._create_pages, groups)
+    # три задания на один прайс: каждое читает XLSX само или все строят деревья из одного чтения
+    stages['parse x3 (separate)'], _ = timed(lambda: [PriceList(log, updated) for _ in range(3)])
+    stages['parse x3 (shared read)'], _ = timed(
+        lambda: [PriceList(log, price_rows) for price_rows in itertools.repeat(list(iter_xlsx_rows(updated)), 3)])
+    snapshots = SnapshotStore(os.path.join(folder, 'snapshots.sqlite3'))
+    stages['snapshot save'], _ = timed(snapshots.save, price_list)
+    stages['snapshot load'], _ = timed(snapshots.latest, price_list.get_keywords())
+    snapshots.close()
+
+    spreadsheet = FakeSpreadsheet(latency=latency)
+    editor = GoogleSpreadsheetEditor(Header(), RateLimiter(per_minute=10 ** 6, burst=10 ** 6), spreadsheet,
+                                     metadata_path=os.path.join(folder, 'metadata.json'))
+    stages['send (full, 1 worker)'], _ = timed(lambda: price_list.send_pages(editor, upload_workers=1))
+    spreadsheet.calls.clear()
+    spreadsheet.payload_bytes.clear()
+    stages[f'send (full, {UPLOAD_WORKERS} workers)'], stages['compose (full)'], stages['upload (full)'] = \
+        timed_send(price_list, editor)
+    full_calls, full_bytes = sum(spreadsheet.calls.values()), sum(spreadsheet.payload_bytes.values())
+
+    spreadsheet.calls.clear()
+    spreadsheet.payload_bytes.clear()
+    incremental = PriceList(log, updated, saved)
+    stages['send (incremental)'], stages['compose (incremental)'], stages['upload (incremental)'] = \
+        timed_send(incremental, editor)
+
+    print(f"rows: {row_count}, depth: {depth}, changed items: {changed}, API latency: {latency}s")
+    for stage, seconds in stages.items():
+        print(f"{stage:>24} {seconds:>9.3f} s")
+    print(f"{'full send':>24} {full_calls:>9} calls {full_bytes / 1024:>10.1f} KiB")
+    print(f"{'incremental send':>24} {sum(spreadsheet.calls.values()):>9} calls "
+          f"{sum(spreadsheet.payload_bytes.values()) / 1024:>10.1f} KiB")
+    for case, ranges in resumes.items():
+        print(f"{'cut download, ' + case:>28}: Range {ranges}")
+
+
+def bench_tree_builders(sizes=(10_000, 50_000, 100_000, 200_000), depths=(3, 7)):
+    """Сравнивает прежний рекурсивный разбор и стековый ItemGroup.from_rows. 7 - предел группировки в Excel."""
+    header = Header().parse_header(HEADER_ROW)
+    print(f"{'rows':>8} {'depth':>6} {'legacy, s':>10} {'stack, s':>10} {'speedup':>8}")
+    for depth in depths:
+        for size in sizes:
+            rows = synthetic_rows(size, depth)
+            legacy_time, legacy_tree = timed(legacy_parse_groups, header, rows)
+            stack_time, stack_tree = timed(stack_parse_groups, header, rows)
+            assert count_nodes(legacy_tree) == count_nodes(stack_tree), "trees differ"
+            print(f"{size:>8} {depth:>6} {legacy_time:>10.3f} {stack_time:>10.3f} {legacy_time / stack_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=20_000)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds per fake Sheets API call")
+    parser.add_argument('--changed', type=int, default=10, help="items with a changed price in the new file")
+    parser.add_argument('--trees', type=int, nargs='*', help="compare group tree builders on these row counts")
+    args = parser.parse_args()
+    if args.trees is not None:
+        bench_tree_builders(tuple(args.trees) or (10_000, 50_000, 100_000, 200_000))
+    else:
+        bench_pipeline(args.rows, args.depth, args.latency, args.changed)
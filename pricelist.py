@@ -1,58 +1,414 @@
-from copy import deepcopy
+import argparse
 import random
+import itertools
+import re
+import hashlib
+import json
+import sqlite3
+import zipfile
+from xml.etree import ElementTree
 from singleton_decorator import singleton
 from datetime import datetime, timedelta
 import time
+import threading
 import logging
+import resource
 import sys
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from oauth2client.service_account import ServiceAccountCredentials
-import openpyxl
 import gspread
+from gspread.utils import a1_range_to_grid_range, absolute_range_name
 import requests
-import io
 import os
 from gspread_formatting import *
 
 URL = "https://89.248.193.157:65002/price/PRC%20(XLSX).xlsx"
 FOLDER = "/var/www/u0853380/data/priceSheets/"
+SPREADSHEET_TITLE = "Запчасти для телефонов, ноутбуков"
+JOBS_FILE = FOLDER + "jobs.json"  # задания: какой прайс, какие страницы, в какую таблицу; без файла - одно наше
+FINGERPRINT_FILE = FOLDER + "pricelist.fingerprint.json"
+SAVED_FILE = FOLDER + "pricelist.xlsx"  # последний обработанный прайс
+DOWNLOAD_FILE = FOLDER + "pricelist.download"  # сюда пишется скачиваемый прайс
+VALIDATORS_FILE = FOLDER + "pricelist.validators.json"  # ETag и Last-Modified последнего обработанного прайса
+SNAPSHOT_DB = FOLDER + "snapshots.sqlite3"  # разобранные версии прайса для сравнения и истории цен
+SNAPSHOT_RETENTION = 30  # сколько последних версий прайса хранить
+SNAPSHOT_MMAP_SIZE = 256 * 1024 * 1024  # байт базы снимков, которые SQLite читает через mmap
+CHECKPOINT_FILE = FOLDER + "upload.checkpoint.json"  # какие листы уже записаны для отправляемой версии прайса
+METADATA_FILE = FOLDER + "spreadsheet.metadata.json"  # ключ таблицы и id листов, чтобы не запрашивать их каждый запуск
+STATS_FILE = FOLDER + "logs/stats.jsonl"  # по строке статистики на каждый запуск
+DOWNLOAD_TIMEOUT = (10, 60)  # секунд на соединение и на ожидание очередного куска ответа
+DOWNLOAD_ATTEMPTS = 4
+DOWNLOAD_CHUNK = 64 * 1024
+# байт на один вызов spreadsheets.batchUpdate. Лист уходит одним вызовом, а вызов применяется целиком или никак,
+# поэтому покупатели не видят лист полупустым. Лист больше предела уходит несколькими вызовами.
+# API не принимает тело запроса больше 10 МБ, держим запас. Считаются байты, как их отправит requests:
+# JSON с ensure_ascii, где кириллическая буква занимает 6 байт (\uXXXX), а не 2 как в UTF-8.
+BATCH_PAYLOAD_LIMIT = 8 * 1024 * 1024
+SHEET_ROW_COUNT = 1000  # рядов на листе, если товаров меньше
+SHEETS_REQUESTS_PER_MINUTE = 60  # квота Sheets API на пользователя в минуту, выставить под квоту проекта
+SHEETS_REQUESTS_BURST = 10  # сколько запросов можно отправить подряд без ожидания
+RETRY_ATTEMPTS = 6  # попыток на запрос при 429/5xx
+RETRY_MAX_DELAY = 64  # секунд, потолок экспоненциальной задержки
+POLL_INTERVAL = 300  # секунд между проверками прайса в режиме --daemon
+UPLOAD_WORKERS = 4  # сколько листов отправлять одновременно, квоту все равно соблюдает общий RateLimiter
+COMPOSE_WORKERS = 4  # сколько листов собирать одновременно, пока отправляются уже собранные
+CLASSIFY_BATCH = 1000  # сколько товаров классифицировать по страницам за один проход
 requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
 
 
-def grab_url_file_to_memory(url):
-    """Берем файл по ссылке и записываем в память, возвращаем в виде потока байтов."""
-    r = requests.get(url, verify=False)
-    f = io.BytesIO(r.content)
-    return f
-
-
-def xlsx_compare(first, second):
-    """Принимаем 2 xlsx-файла, снимаем объединения ячеек в обоих.
-    Перегоняем данные из ячеек в массивы. Возвращаем результат сравнения массивов."""
-    wb_first = openpyxl.load_workbook(first).active
-
-    for merge in list(wb_first.merged_cells):
-        wb_first.unmerge_cells(range_string=str(merge))
-
-    wb_second = openpyxl.load_workbook(second).active
-
-    for merge in list(wb_second.merged_cells):
-        wb_second.unmerge_cells(range_string=str(merge))
-
-    row_new_list = []
-    row_old_list = []
-
-    for row_new, row_old in zip(wb_first.iter_rows(), wb_second.iter_rows()):
-        [row_new_list.append([cell_new.coordinate, cell_new.internal_value]) for cell_new in row_new]
-        [row_old_list.append([cell_old.coordinate, cell_old.internal_value]) for cell_old in row_old]
-
-    return row_new_list == row_old_list
+class InvalidJob(ValueError):
+    """Ошибка в описании задания в jobs.json"""
+
+
+class IncompleteDownload(IOError):
+    pass
+
+
+class PriceDownloader:
+    """Скачивает прайс по ссылке через общую сессию requests.
+    Отправляет ETag/Last-Modified прошлого обработанного прайса, поэтому неизменившийся файл стоит одного ответа 304.
+    Тело ответа пишется на диск кусками, при обрыве связи докачивается запросом Range с If-Range.
+    Если сервер не прислал ни ETag, ни Last-Modified, докачка не проверит, что файл тот же, - качаем заново."""
+
+    def __init__(self, url, path=DOWNLOAD_FILE, validators_path=VALIDATORS_FILE, session=None):
+        self._url = url
+        self._path = path
+        self._validators_path = validators_path
+        self._session = session if session is not None else requests.Session()
+        self._session.verify = False
+        self._validators = {}
+
+    def _load_validators(self) -> dict:
+        try:
+            with open(self._validators_path, 'r', encoding='utf-8') as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return {}
+
+    def save_validators(self):
+        """Запоминает ETag/Last-Modified скачанного файла. Вызывать только после того, как прайс обработан,
+        иначе после сбоя сервер ответит 304 и изменения так и не попадут в таблицу."""
+        with open(self._validators_path + '.tmp', 'w', encoding='utf-8') as outfile:
+            json.dump(self._validators, outfile)
+        os.replace(self._validators_path + '.tmp', self._validators_path)
+
+    def fetch(self, conditional=True):
+        """Скачивает прайс в self._path. Возвращает файл, открытый на чтение, или None, если прайс не изменился (304).
+        conditional=False - скачать в любом случае, например когда сохраненного прайса нет."""
+        headers = {}
+        if conditional:
+            validators = self._load_validators()
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+        received = 0
+        with open(self._path, 'wb') as outfile:
+            for attempt in range(DOWNLOAD_ATTEMPTS):
+                request_headers = dict(headers)
+                validator = self._validators.get('etag') or self._validators.get('last_modified')
+                if received and validator:
+                    # докачиваем, только если на сервере тот же самый файл
+                    request_headers['Range'] = f'bytes={received}-'
+                    request_headers['If-Range'] = validator
+                try:
+                    received = self._download(request_headers, outfile, received)
+                    if received is None:
+                        return None
+                    break
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                        IncompleteDownload) as error:
+                    received = outfile.tell()
+                    if attempt + 1 == DOWNLOAD_ATTEMPTS:
+                        raise
+                    logging.getLogger(__name__).warning(f"Download interrupted at {received} bytes ({error}), retrying.")
+                    time.sleep(2 ** attempt)
+        return open(self._path, 'rb')
+
+    def _download(self, headers: dict, outfile, received: int):
+        """Один запрос. Возвращает количество байт в файле или None на 304."""
+        with self._session.get(self._url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            if response.status_code == 304:
+                return None
+            if response.status_code >= 500:
+                raise IncompleteDownload(f"server responded {response.status_code}")
+            response.raise_for_status()
+            if response.status_code != 206:
+                # сервер отдал файл целиком - пишем с начала
+                outfile.seek(0)
+                outfile.truncate()
+                received = 0
+                self._validators = {'etag': response.headers.get('ETag'),
+                                    'last_modified': response.headers.get('Last-Modified')}
+                expected = response.headers.get('Content-Length')
+            else:
+                expected = response.headers.get('Content-Range', '').rpartition('/')[2]
+                expected = None if expected in ('', '*') else expected
+            for chunk in response.iter_content(DOWNLOAD_CHUNK):
+                outfile.write(chunk)
+                received += len(chunk)
+            outfile.flush()
+            if expected is not None and received < int(expected):
+                raise IncompleteDownload(f"got {received} of {expected} bytes")
+            return received
+
+
+_XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_DOC_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_PKG_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+
+def _xlsx_text(element) -> str:
+    """Собирает текст из <si> или <is>: простой <t> или набор кусков <r><t>."""
+    parts = []
+    for child in element:
+        if child.tag == _XLSX_NS + 't':
+            parts.append(child.text or '')
+        elif child.tag == _XLSX_NS + 'r':
+            parts.extend(t.text or '' for t in child.iter(_XLSX_NS + 't'))
+    return ''.join(parts)
+
+
+def _xlsx_shared_strings(archive: zipfile.ZipFile) -> list:
+    if 'xl/sharedStrings.xml' not in archive.namelist():
+        return []
+    strings = []
+    with archive.open('xl/sharedStrings.xml') as stream:
+        for _, element in ElementTree.iterparse(stream):
+            if element.tag == _XLSX_NS + 'si':
+                strings.append(_xlsx_text(element))
+                element.clear()
+    return strings
+
+
+def _xlsx_active_sheet_path(archive: zipfile.ZipFile) -> str:
+    """Ищет в архиве путь к xml активного листа, так же как это делает openpyxl (workbook.active)."""
+    workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+    view = workbook.find(f'{_XLSX_NS}bookViews/{_XLSX_NS}workbookView')
+    active_tab = int(view.get('activeTab', 0)) if view is not None else 0
+    sheets = workbook.findall(f'{_XLSX_NS}sheets/{_XLSX_NS}sheet')
+    rel_id = sheets[min(active_tab, len(sheets) - 1)].get(_DOC_REL_NS + 'id')
+    rels = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    for rel in rels.iter(_PKG_REL_NS + 'Relationship'):
+        if rel.get('Id') == rel_id:
+            target = rel.get('Target')
+            return target.lstrip('/') if target.startswith('/') else 'xl/' + target
+    raise KeyError(f"Sheet relationship {rel_id} not found in workbook")
+
+
+def _xlsx_column_index(reference: str) -> int:
+    """'AB12' -> 28"""
+    index = 0
+    for char in reference:
+        if not char.isalpha():
+            break
+        index = index * 26 + ord(char.upper()) - 64
+    return index
+
+
+def _xlsx_number(text: str):
+    """Приводит число из xml к int или float, как openpyxl."""
+    if '.' in text or 'E' in text or 'e' in text:
+        return float(text)
+    return int(text)
+
+
+def iter_xlsx_rows(file_data):
+    """Потоково читает активный лист xlsx без openpyxl.
+    Для каждого ряда отдает tuple(номер ряда, уровень группировки, {номер колонки: значение}).
+    Отдаются только ряды, присутствующие в файле."""
+    file_data.seek(0)
+    with zipfile.ZipFile(file_data) as archive:
+        shared_strings = _xlsx_shared_strings(archive)
+        with archive.open(_xlsx_active_sheet_path(archive)) as stream:
+            sheet_data = None
+            row_number = 0
+            for event, element in ElementTree.iterparse(stream, events=('start', 'end')):
+                if event == 'start':
+                    if element.tag == _XLSX_NS + 'sheetData':
+                        sheet_data = element
+                    continue
+                if element.tag != _XLSX_NS + 'row':
+                    continue
+                row_number = int(element.get('r', row_number + 1))
+                values = {}
+                column = 0
+                for cell in element.iter(_XLSX_NS + 'c'):
+                    reference = cell.get('r')
+                    column = _xlsx_column_index(reference) if reference else column + 1
+                    cell_type = cell.get('t', 'n')
+                    if cell_type == 'inlineStr':
+                        inline = cell.find(_XLSX_NS + 'is')
+                        if inline is not None:
+                            values[column] = _xlsx_text(inline)
+                        continue
+                    value = cell.find(_XLSX_NS + 'v')
+                    if value is None or value.text is None:
+                        continue
+                    if cell_type == 's':
+                        values[column] = shared_strings[int(value.text)]
+                    elif cell_type == 'n':
+                        values[column] = _xlsx_number(value.text)
+                    elif cell_type == 'b':
+                        values[column] = value.text == '1'
+                    else:  # str, e, d - оставляем как есть
+                        values[column] = value.text
+                yield row_number, int(element.get('outlineLevel', 0)), values
+                if sheet_data is not None:
+                    sheet_data.clear()
+
+
+def _raw_digest(file_data) -> str:
+    """Хэш сырых байтов файла."""
+    digest = hashlib.sha256()
+    file_data.seek(0)
+    for chunk in iter(lambda: file_data.read(1 << 20), b''):
+        digest.update(chunk)
+    file_data.seek(0)
+    return digest.hexdigest()
+
+
+def _rows_digest(file_data) -> str:
+    """Хэш нормализованного содержимого листа: номера рядов, уровни группировки и значения ячеек.
+    Не зависит от метаданных zip-архива, стилей и порядка общих строк."""
+    digest = hashlib.sha256()
+    for row_number, outline_level, values in iter_xlsx_rows(file_data):
+        row = (row_number, outline_level, sorted(values.items()))
+        digest.update(hashlib.sha256(repr(row).encode('utf-8')).digest())
+    file_data.seek(0)
+    return digest.hexdigest()
+
+
+class FileFingerprint:
+    """Отпечаток содержимого прайса, хранится рядом с pricelist.xlsx.
+    Позволяет понять, что прайс не изменился, не разбирая книгу через openpyxl."""
+
+    def __init__(self, raw=None, rows=None):
+        self.raw = raw
+        self.rows = rows
+
+    @classmethod
+    def of(cls, file_data):
+        """Снимает отпечаток с файла."""
+        return cls(_raw_digest(file_data), _rows_digest(file_data))
+
+    @classmethod
+    def load(cls, path):
+        """Читает сохраненный отпечаток. Если файла нет или он битый - возвращает None."""
+        try:
+            with open(path, 'r', encoding='utf-8') as infile:
+                data = json.load(infile)
+            return cls(data['raw'], data['rows'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, path):
+        with open(path + '.tmp', 'w', encoding='utf-8') as outfile:
+            json.dump({'raw': self.raw, 'rows': self.rows}, outfile)
+        os.replace(path + '.tmp', path)
+
+    def compare(self, file_data):
+        """Снимает отпечаток с нового файла, сверяясь с этим. Сначала хэш байтов - это миллисекунды:
+        совпал - ряды те же, книгу не разбираем. Иначе считаем хэш рядов, файл мог пересобраться с другими
+        метаданными архива. Файл не изменился, если у отпечатков одинаковые rows; изменившийся сохраняется
+        с этим же отпечатком, не разбирая книгу второй раз."""
+        raw = _raw_digest(file_data)
+        if raw == self.raw:
+            return FileFingerprint(raw, self.rows)
+        return FileFingerprint(raw, _rows_digest(file_data))
+
+    def matches(self, file_data) -> bool:
+        return self.compare(file_data).rows == self.rows
+
+
+class UploadJournal:
+    """Журнал отправки: какие листы уже записаны для версии прайса с отпечатком fingerprint.
+    Если отправка оборвалась, следующая попытка той же версии отправляет только оставшиеся листы.
+    Листы, записанные недоотправленной другой версией, считаются устаревшими и перезаписываются целиком."""
+
+    def __init__(self, path, fingerprint: str):
+        self._path = path
+        self._fingerprint = fingerprint
+        self._lock = threading.Lock()
+        self._done = set()
+        self._stale = set()
+        try:
+            with open(path, 'r', encoding='utf-8') as infile:
+                data = json.load(infile)
+            if data['fingerprint'] == fingerprint:
+                self._done = set(data['sheets'])
+                self._stale = set(data['stale'])
+            else:
+                self._stale = set(data['sheets']) | set(data['stale'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def is_done(self, sheet_index: int) -> bool:
+        return sheet_index in self._done
+
+    def is_stale(self, sheet_index: int) -> bool:
+        return sheet_index in self._stale
+
+    def get_done(self) -> set:
+        return set(self._done)
+
+    def mark_done(self, sheet_index: int):
+        """Лист записан - сразу фиксируем на диске. Можно вызывать из разных потоков."""
+        with self._lock:
+            self._done.add(sheet_index)
+            self._stale.discard(sheet_index)
+            self._save()
+
+    def mark_stale(self, sheet_indexes: set):
+        """Листы надо перезаписать целиком - журнал остается, и следующая проверка их перезапишет."""
+        with self._lock:
+            self._done -= sheet_indexes
+            self._stale |= sheet_indexes
+            self._save()
+
+    def _save(self):
+        with open(self._path + '.tmp', 'w', encoding='utf-8') as outfile:
+            json.dump({'fingerprint': self._fingerprint, 'sheets': sorted(self._done),
+                       'stale': sorted(self._stale)}, outfile)
+        os.replace(self._path + '.tmp', self._path)
+
+    def finish(self):
+        """Версия отправлена и сохранена целиком - журнал больше не нужен."""
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+
+class DailyLogHandler(logging.FileHandler):
+    """Пишет лог в файл текущего дня folder/%m_%d_%Y.log. Процесс --daemon живет дольше суток,
+    поэтому после полуночи переходит на файл нового дня - раскладка по дням та же, что у запусков из cron."""
+
+    def __init__(self, folder):
+        self._folder = folder
+        self._day = datetime.now().date()
+        super().__init__(self._day_path(self._day), mode='a')
+
+    def _day_path(self, day) -> str:
+        return os.path.join(self._folder, f'{day.strftime("%m_%d_%Y")}.log')
+
+    def emit(self, record):
+        day = datetime.fromtimestamp(record.created).date()
+        if day != self._day:
+            # emit вызывается под замком обработчика, файл можно сменить здесь
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+            self.baseFilename = os.path.abspath(self._day_path(day))
+            self._day = day
+        super().emit(record)
 
 
 @singleton
 def logger():
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
-                        level=logging.INFO, filename=FOLDER + f'logs/{datetime.now().strftime("%m_%d_%Y")}.log',
-                        filemode='a')
+                        level=logging.INFO, handlers=[DailyLogHandler(FOLDER + 'logs')])
     log_maker = logging.getLogger(__name__)
     handler = logging.StreamHandler(sys.stdout)
     handler.setLevel(logging.DEBUG)
@@ -63,24 +419,162 @@ def logger():
 
 
 @singleton
-class Header:
-    """Содержит информацию для заголовка страниц, дату последнего обновления, наименования столбцов."""
+class RunStats:
+    """Статистика запуска: время этапов (по часам и по процессору), вызовы Sheets API и байты запросов по листам,
+    повторы запросов, пиковая память. В конце запуска дописывается JSON-строкой в STATS_FILE."""
 
     def __init__(self):
+        self._lock = threading.Lock()
+        self._started = datetime.now()
+        self._stages = {}
+        self._sheets = {}
+        self._sheet_titles = {}
+        self._spreadsheet_titles = {}
+        self._api_calls = 0
+        self._retries = 0
+        self._retry_delay = 0.0
+
+    @contextmanager
+    def stage(self, name: str):
+        """Замеряет этап: with RunStats().stage('parse'): ... Повторные замеры одного этапа складываются.
+        Процессорное время считается по потоку, выполняющему этап: этапы могут идти параллельно."""
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            with self._lock:
+                stage = self._stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+                stage['wall'] += wall
+                stage['cpu'] += cpu
+
+    def count_call(self):
+        with self._lock:
+            self._api_calls += 1
+
+    def count_retry(self, delay: float):
+        with self._lock:
+            self._retries += 1
+            self._retry_delay += delay
+
+    def count_sheet_call(self, spreadsheet_id, sheet_id, payload_bytes: int):
+        """Лист считается вместе с ключом таблицы: id листов в разных таблицах повторяются."""
+        with self._lock:
+            sheet = self._sheets.setdefault((spreadsheet_id, sheet_id), {'calls': 0, 'bytes': 0})
+            sheet['calls'] += 1
+            sheet['bytes'] += payload_bytes
+
+    def set_sheet_titles(self, spreadsheet_id, spreadsheet_title: str, titles: dict):
+        """Название таблицы и {id листа: название}, чтобы в статистике листы были подписаны.
+        Таблиц может быть несколько - дополняем."""
+        with self._lock:
+            self._spreadsheet_titles[spreadsheet_id] = spreadsheet_title
+            self._sheet_titles.update(((spreadsheet_id, sheet_id), title) for sheet_id, title in titles.items())
+
+    def as_dict(self, **extra) -> dict:
+        with self._lock:
+            sheets = {}  # {таблица: {лист: счетчики}}
+            for key, sheet in self._sheets.items():
+                spreadsheet = sheets.setdefault(str(self._spreadsheet_titles.get(key[0], key[0])), {})
+                spreadsheet[str(self._sheet_titles.get(key, key[1]))] = dict(sheet)
+            return {'started': self._started.isoformat(timespec='seconds'),
+                    'wall': round((datetime.now() - self._started).total_seconds(), 3),
+                    'stages': {name: {key: round(value, 3) for key, value in stage.items()}
+                               for name, stage in self._stages.items()},
+                    'api_calls': self._api_calls,
+                    'retries': self._retries,
+                    'retry_delay': round(self._retry_delay, 3),
+                    'sheets': sheets,
+                    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                    **extra}
+
+    def reset(self):
+        """Начинает статистику заново - для следующей проверки в режиме --daemon. Названия листов остаются."""
+        sheet_titles, spreadsheet_titles = self._sheet_titles, self._spreadsheet_titles
+        self.__init__()
+        self._sheet_titles, self._spreadsheet_titles = sheet_titles, spreadsheet_titles
+
+    def save(self, path=STATS_FILE, **extra):
+        """Дописывает статистику запуска строкой JSON. extra - дополнительные поля, например итог запуска."""
+        with open(path, 'a', encoding='utf-8') as outfile:
+            outfile.write(json.dumps(self.as_dict(**extra), ensure_ascii=False) + '\n')
+
+
+class KeywordMatcher:
+    """Распределяет товары по страницам. Строится один раз из ключевых слов страниц:
+    все слова собираются в одно регулярное выражение, название товара просматривается за один проход.
+    Результат - маска страниц, бит N выставлен, если товар попадает на страницу N."""
+
+    def __init__(self, keywords: list):
+        self._fallback = 1 << (len(keywords) - 1)  # если ни одного слова не совпало - последняя страница
+        masks = {}
+        for page in range(len(keywords)):
+            for word in keywords[page]:
+                masks[word.lower()] = masks.get(word.lower(), 0) | 1 << page
+        # выражение находит в каждой позиции самое длинное слово, поэтому
+        # страницы слов-префиксов, начинающихся там же, добавляем к маске найденного слова
+        self._masks = {word: 0 for word in masks}
+        for word in masks:
+            for other in masks:
+                if word.startswith(other):
+                    self._masks[word] |= masks[other]
+        words = '|'.join(re.escape(word) for word in sorted(masks, key=len, reverse=True))
+        first_chars = ''.join(sorted(set(re.escape(word[0]) for word in masks)))
+        # просмотр вперед, чтобы находить и пересекающиеся слова
+        self._pattern = re.compile(f'(?=[{first_chars}])(?=({words}))')
+        self._batch_pattern = re.compile(f'(?=[\\x00{first_chars}])(?=(\\x00|{words}))')
+
+    def classify(self, name) -> int:
+        mask = 0
+        for word in self._pattern.findall(str(name).lower()):
+            mask |= self._masks[word]
+        return mask or self._fallback
+
+    def classify_many(self, names: list) -> list:
+        """Классифицирует пачку названий одним проходом по склеенному через \\x00 тексту."""
+        if len(names) == 0:
+            return []
+        result = []
+        mask = 0
+        for word in self._batch_pattern.findall('\x00'.join(str(name) for name in names).lower()):
+            if word == '\x00':
+                result.append(mask or self._fallback)
+                mask = 0
+            else:
+                mask |= self._masks[word]
+        result.append(mask or self._fallback)
+        return result
+
+
+class Header:
+    """Содержит информацию для заголовка страниц, дату последнего обновления, наименования столбцов.
+    keywords - ключевые слова страниц, contacts - тексты шапки (phone, address, hours); по умолчанию - наши."""
+
+    def __init__(self, keywords=None, contacts=None):
         self._header_text_rows = {'phone': "Телефон: 071-312-3-777, Эдгар",
                                   'address': "ул. Буденновских партизан, 83а(рынок Объединенный, кольцо трамвая)",
                                   'hours': "Ежедневно 10.00-18.00",
                                   'DT': f"Последнее обновление: {datetime.now().strftime('%H:%M %d/%m')}"}
+        if contacts is not None:
+            self._header_text_rows.update(contacts)
         self._col_dict = {}
+        self._col_positions = {}
         self._keywords = []
         self._set_keywords()
+        if keywords is not None:
+            self._keywords = [list(page) for page in keywords]
+        self._matcher = KeywordMatcher(self._keywords)
 
     def parse_header(self, *rows):
-        """Получаем несколько рядов из заголовка, считываем названия колонок, возвращаем объект Header."""
+        """Получаем несколько рядов из заголовка в виде {номер колонки: значение},
+        считываем названия колонок, возвращаем объект Header."""
+        self._col_dict = {}
         for row in rows:
-            for cell in row:
-                if cell.value and cell.value != 'Цена':
-                    self._col_dict[cell.column] = cell.value
+            for column, value in row.items():
+                if value and value != 'Цена':
+                    self._col_dict[column] = value
+        # Item хранит значения кортежем в порядке колонок _col_dict, здесь позиция значения по названию колонки
+        self._col_positions = {name: position for position, name in enumerate(self._col_dict.values())}
         return self
 
     def _set_keywords(self):
@@ -91,12 +585,20 @@ class Header:
     def get_keywords(self):
         return self._keywords
 
+    def get_matcher(self) -> KeywordMatcher:
+        return self._matcher
+
     def get_header_text(self):
+        # Header живет, пока живет задание, в режиме --daemon время обновления должно быть текущим
+        self._header_text_rows['DT'] = f"Последнее обновление: {datetime.now().strftime('%H:%M %d/%m')}"
         return self._header_text_rows
 
     def get_col_headers(self):
         return self._col_dict
 
+    def get_col_positions(self) -> dict:
+        return self._col_positions
+
     def get_col_headers_cleaned(self) -> list:
         clean = []
         description = False
@@ -111,118 +613,485 @@ class Header:
         return clean
 
 
+class RateLimiter:
+    """Token bucket для всех запросов к Google Sheets API. Пропускает запросы так быстро, как позволяет квота.
+    При ответах 429/5xx повторяет запрос с экспоненциальной задержкой и случайным разбросом.
+    Считает запросы по минутам, повторы учитывает RunStats."""
+
+    def __init__(self, per_minute=SHEETS_REQUESTS_PER_MINUTE, burst=SHEETS_REQUESTS_BURST,
+                 attempts=RETRY_ATTEMPTS, max_delay=RETRY_MAX_DELAY):
+        self._rate = per_minute / 60
+        self._burst = burst
+        self._attempts = attempts
+        self._max_delay = max_delay
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def acquire(self):
+        """Забираем токен. Если токенов нет - ждем, пока накопится."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+            minute = datetime.now().strftime('%Y-%m-%d %H:%M')
+            self._counters[minute] = self._counters.get(minute, 0) + 1
+        if wait > 0:
+            time.sleep(wait)
+
+    def call(self, func, *args, **kwargs):
+        """Вызывает func с учетом квоты, повторяет при превышении квоты и ошибках сервера."""
+        for attempt in range(self._attempts):
+            self.acquire()
+            RunStats().count_call()
+            try:
+                return func(*args, **kwargs)
+            except gspread.exceptions.APIError as error:
+                status = error.response.status_code
+                if (status != 429 and status < 500) or attempt + 1 == self._attempts:
+                    raise
+                delay = random.uniform(0, min(self._max_delay, 2 ** attempt))
+                RunStats().count_retry(delay)
+                logging.getLogger(__name__).warning(f"Sheets API responded {status}, retry in {delay:.1f}s.")
+                time.sleep(delay)
+
+    def pop_counters(self) -> dict:
+        """Возвращает dict вида {'2022-03-01 12:15': кол-во запросов за минуту} с прошлого вызова и забывает их:
+        в режиме --daemon счетчики уходят в статистику каждой проверки и не копятся."""
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            return counters
+
+
+class SheetRequestBuilder:
+    """Собирает запросы spreadsheets.batchUpdate для всех листов: структура, оформление, объединения, значения.
+    Отправляет их минимальным числом вызовов, не превышая payload_limit байт на вызов.
+    Запросы уходят в том порядке, в котором были добавлены."""
+
+    def __init__(self, spreadsheet, limiter: RateLimiter, payload_limit=BATCH_PAYLOAD_LIMIT):
+        self._spreadsheet = spreadsheet
+        self._limiter = limiter
+        self._payload_limit = payload_limit
+        self.clear()
+
+    @staticmethod
+    def _payload_size(request: dict) -> int:
+        """Размер запроса в теле вызова: gspread отдает тело в requests через json=, а тот пишет ensure_ascii=True.
+        +2 - разделитель ', ' между запросами в списке."""
+        return len(json.dumps(request)) + 2
+
+    def add(self, request: dict, sheet_id=None, size=None):
+        """size - размер запроса, если уже посчитан"""
+        if size is None:
+            size = self._payload_size(request)
+        if self._batches[-1] and self._batch_size + size > self._payload_limit:
+            self._batches.append([])
+            self._batch_sheets.append({})
+            self._batch_size = 0
+        self._batches[-1].append(request)
+        self._batch_sheets[-1][sheet_id] = self._batch_sheets[-1].get(sheet_id, 0) + size
+        self._batch_size += size
+
+    @staticmethod
+    def _dimension_range(sheet_id: int, a1_range: str) -> dict:
+        """'B:H' -> диапазон колонок, '4:500' -> диапазон рядов"""
+        grid = a1_range_to_grid_range(a1_range)
+        dimension = 'ROWS' if 'startRowIndex' in grid else 'COLUMNS'
+        prefix = 'Row' if dimension == 'ROWS' else 'Column'
+        return {'sheetId': sheet_id, 'dimension': dimension,
+                'startIndex': grid[f'start{prefix}Index'], 'endIndex': grid[f'end{prefix}Index']}
+
+    @staticmethod
+    def _cell_value(value) -> dict:
+        if value is None:
+            return {}
+        if isinstance(value, bool):
+            return {'userEnteredValue': {'boolValue': value}}
+        if isinstance(value, (int, float)):
+            return {'userEnteredValue': {'numberValue': value}}
+        return {'userEnteredValue': {'stringValue': str(value)}}
+
+    def clear_columns(self, sheet_id: int, count: int):
+        """Аналог delete_columns: сносим первые count колонок вместе со значениями, стилями и объединениями.
+        Сначала добавляем столько же пустых, чтобы не удалить все колонки листа."""
+        self.add({'appendDimension': {'sheetId': sheet_id, 'dimension': 'COLUMNS', 'length': count}}, sheet_id)
+        self.add({'deleteDimension': {'range': {'sheetId': sheet_id, 'dimension': 'COLUMNS',
+                                                'startIndex': 0, 'endIndex': count}}}, sheet_id)
+
+    def set_grid(self, sheet_id: int, row_count: int, frozen_rows: int):
+        self.add({'updateSheetProperties': {
+            'properties': {'sheetId': sheet_id, 'gridProperties': {'rowCount': row_count,
+                                                                   'frozenRowCount': frozen_rows}},
+            'fields': 'gridProperties.rowCount,gridProperties.frozenRowCount'}}, sheet_id)
+
+    def set_values(self, sheet_id: int, a1_range: str, values: list):
+        grid = a1_range_to_grid_range(a1_range)
+        self._add_rows(sheet_id, grid['startRowIndex'], grid['startColumnIndex'],
+                       [{'values': [self._cell_value(value) for value in row]} for row in values])
+
+    def _add_rows(self, sheet_id: int, row_index: int, column_index: int, rows: list):
+        """Один updateCells на блок рядов. Блок, который сам не влезает в вызов, делим пополам."""
+        request = {'updateCells': {'start': {'sheetId': sheet_id, 'rowIndex': row_index, 'columnIndex': column_index},
+                                   'rows': rows, 'fields': 'userEnteredValue'}}
+        size = self._payload_size(request)
+        if len(rows) > 1 and size > self._payload_limit:
+            half = len(rows) // 2
+            self._add_rows(sheet_id, row_index, column_index, rows[:half])
+            self._add_rows(sheet_id, row_index + half, column_index, rows[half:])
+            return
+        self.add(request, sheet_id, size)
+
+    def set_dimension_sizes(self, sheet_id: int, sizes: list):
+        """sizes - список tuple(диапазон колонок или рядов, размер в пикселях)"""
+        for a1_range, size in sizes:
+            self.add({'updateDimensionProperties': {'range': self._dimension_range(sheet_id, a1_range),
+                                                    'properties': {'pixelSize': size},
+                                                    'fields': 'pixelSize'}}, sheet_id)
+
+    def format_ranges(self, sheet_id: int, formats: list):
+        """formats - список tuple(диапазон, CellFormat), как для format_cell_ranges"""
+        for a1_range, cell_format in formats:
+            self.add({'repeatCell': {
+                'range': a1_range_to_grid_range(a1_range, sheet_id),
+                'cell': {'userEnteredFormat': cell_format.to_props()},
+                'fields': ','.join(cell_format.affected_fields('userEnteredFormat'))}}, sheet_id)
+
+    def merge(self, sheet_id: int, a1_range: str):
+        self.add({'mergeCells': {'range': a1_range_to_grid_range(a1_range, sheet_id), 'mergeType': 'MERGE_ALL'}},
+                 sheet_id)
+
+    def get_sheet_ids(self) -> set:
+        """id листов, к которым относятся накопленные запросы"""
+        return set().union(*self._batch_sheets)
+
+    def retarget(self, sheet_id: int):
+        """Переносит все накопленные запросы на лист sheet_id - когда id листа из кэша оказался устаревшим."""
+
+        def replace(value):
+            if isinstance(value, dict):
+                if 'sheetId' in value:
+                    value['sheetId'] = sheet_id
+                for nested in value.values():
+                    replace(nested)
+            elif isinstance(value, list):
+                for nested in value:
+                    replace(nested)
+
+        replace(self._batches)
+        self._batch_sheets = [{sheet_id: sum(sheets.values())} if sheets else {} for sheets in self._batch_sheets]
+
+    def execute(self) -> int:
+        """Отправляет накопленные запросы, возвращает количество вызовов API."""
+        if len(self._batches) > 1:
+            logging.getLogger(__name__).warning(f"Requests exceed {self._payload_limit} bytes, "
+                                                f"sending in {len(self._batches)} calls, not atomically.")
+        calls = 0
+        for batch, sheets in zip(self._batches, self._batch_sheets):
+            if batch:
+                self._limiter.call(self._spreadsheet.batch_update, {'requests': batch})
+                calls += 1
+                for sheet_id, size in sheets.items():
+                    RunStats().count_sheet_call(self._spreadsheet.id, sheet_id, size)
+        self.clear()
+        return calls
+
+    def clear(self):
+        """Отбрасывает накопленные запросы."""
+        self._batches = [[]]
+        self._batch_sheets = [{}]
+        self._batch_size = 0
+
+
+class SpreadsheetMetadata:
+    """Кэш метаданных таблицы: название и ключ книги, id листов в порядке страниц вместе с их названиями.
+    Пока названия страниц те же и API не ответил ошибкой на id из кэша, листы не перепроверяются."""
+
+    def __init__(self, key=None, sheets=None, title=None):
+        self.key = key
+        self.title = title  # название книги, которой принадлежит ключ
+        self.sheets = sheets if sheets is not None else []  # [(id листа, название)] в порядке страниц
+
+    @classmethod
+    def load(cls, path):
+        """Читает сохраненный кэш. Если файла нет или он битый - возвращает None."""
+        try:
+            with open(path, 'r', encoding='utf-8') as infile:
+                data = json.load(infile)
+            return cls(data['key'], [(sheet_id, title) for sheet_id, title in data['sheets']], data.get('title'))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, path):
+        with open(path + '.tmp', 'w', encoding='utf-8') as outfile:
+            json.dump({'key': self.key, 'title': self.title, 'sheets': self.sheets}, outfile, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+    def matches(self, key, titles: list) -> bool:
+        return self.key == key and [title for _, title in self.sheets] == list(titles)
+
+    def get_ids(self) -> list:
+        return [sheet_id for sheet_id, _ in self.sheets]
+
+
 @singleton
+def google_client():
+    """Авторизованный клиент gspread, один на процесс: токен получаем один раз для всех таблиц."""
+    scope = ["https://spreadsheets.google.com/feeds",
+             "https://www.googleapis.com/auth/spreadsheets",
+             "https://www.googleapis.com/auth/drive.file",
+             "https://www.googleapis.com/auth/drive",
+             "https://www.googleapis.com/auth/drive.readonly",
+             "https://www.googleapis.com/auth/spreadsheets.readonly"]
+    credentials = ServiceAccountCredentials.from_json_keyfile_name(FOLDER + "creds.json", scope)
+    return gspread.authorize(credentials)
+
+
 class GoogleSpreadsheetEditor:
-    def __init__(self, update_only_time=False):
-        self.spreadsheet = self.auth_workbook()
-        self.sheet_titles = ['\\'.join(x) for x in Header().get_keywords()]
-        self._check_worksheets()
-        if update_only_time:
-            self.update_time()
+    def __init__(self, header: Header, limiter=None, spreadsheet=None, metadata_path=METADATA_FILE,
+                 title=SPREADSHEET_TITLE):
+        """header - Header задания, по его ключевым словам называются листы.
+        limiter - общий на все таблицы RateLimiter: квота считается на сервисный аккаунт, а не на таблицу.
+        spreadsheet - уже открытая книга gspread или ее заменитель, по умолчанию открываем таблицу title сами.
+        metadata_path - кэш ключа таблицы и id листов, с ним запуск обходится без запросов метаданных."""
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.sheet_titles = ['\\'.join(x) for x in header.get_keywords()]
+        self.title = title
+        self._metadata_path = metadata_path
+        self._metadata_lock = threading.Lock()
+        self._replaced = set()  # страницы, чей лист создан или переименован из чужого и еще не записан целиком
+        self._rewrites = set()  # страницы, у которых в очереди полная перезапись листа
+        metadata = SpreadsheetMetadata.load(metadata_path)
+        # ключ из кэша годится, только пока задание пишет в ту же книгу - сменили название, открываем новую
+        key = metadata.key if metadata is not None and metadata.title == title else None
+        self.spreadsheet = spreadsheet if spreadsheet is not None else self.auth_workbook(self.limiter, key, title)
+        if metadata is not None and metadata.matches(self.spreadsheet.id, self.sheet_titles):
+            self._sheet_ids = metadata.get_ids()
+            self._metadata_checked = False  # id взяты из кэша, API их еще не подтвердил
+            RunStats().set_sheet_titles(self.spreadsheet.id, self.title, dict(zip(self._sheet_ids, self.sheet_titles)))
+        else:
+            self._refresh_metadata()
+        # у каждого листа своя очередь запросов, чтобы листы можно было отправлять независимо и одновременно
+        self._requests = [SheetRequestBuilder(self.spreadsheet, self.limiter) for _ in self._sheet_ids]
 
     @staticmethod
-    def auth_workbook():
-        scope = ["https://spreadsheets.google.com/feeds",
-                 "https://www.googleapis.com/auth/spreadsheets",
-                 "https://www.googleapis.com/auth/drive.file",
-                 "https://www.googleapis.com/auth/drive",
-                 "https://www.googleapis.com/auth/drive.readonly",
-                 "https://www.googleapis.com/auth/spreadsheets.readonly"]
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(FOLDER + "creds.json", scope)
-        client = gspread.authorize(credentials)
-        book = client.open("Запчасти для телефонов, ноутбуков")
+    def auth_workbook(limiter: RateLimiter, key=None, title=SPREADSHEET_TITLE):
+        """Открывает таблицу по ключу из кэша, а если его нет или он устарел - по названию."""
+        client = google_client()
+        if key is not None:
+            try:
+                return limiter.call(client.open_by_key, key)
+            except (gspread.exceptions.SpreadsheetNotFound, gspread.exceptions.APIError) as error:
+                logging.getLogger(__name__).warning(f"Cached spreadsheet key failed ({error}), opening by title.")
+        book = limiter.call(client.open, title)
         return book
 
-    def _check_worksheets(self):
-        """Проверяем, чтобы все страницы были на местах. При необходимости удаляем/добавляем/переименовываем."""
-        sheets = self.spreadsheet.worksheets()
+    def _check_worksheets(self) -> list:
+        """Проверяем, чтобы все страницы были на местах. При необходимости удаляем/добавляем/переименовываем/
+        переставляем - только то, что не совпадает. Возвращает листы в порядке страниц."""
+        sheets = self.limiter.call(self.spreadsheet.worksheets)
         # если страниц слишком мало - добавляем
         if len(sheets) < len(self.sheet_titles):
             for i in range(len(self.sheet_titles) - len(sheets)):
-                self.spreadsheet.add_worksheet(str(random.randint(1, 999999)), 1000, 10)
-        # если страниц слишком много - удаляем
+                self.limiter.call(self.spreadsheet.add_worksheet, str(random.randint(1, 999999)), 1000, 10)
+            sheets = self.limiter.call(self.spreadsheet.worksheets)
+        # если страниц слишком много - удаляем, сначала листы с названиями, которых нет среди страниц
         elif len(sheets) > len(self.sheet_titles):
-            for i in range(len(self.sheet_titles), len(sheets)):
-                self.spreadsheet.del_worksheet(sheets[i])
-
-        sheets = self.spreadsheet.worksheets()
+            wanted = set(self.sheet_titles)
+            extra = set(sorted(range(len(sheets)), key=lambda j: (sheets[j].title in wanted, -j))
+                        [:len(sheets) - len(self.sheet_titles)])
+            for j in sorted(extra):
+                self.limiter.call(self.spreadsheet.del_worksheet, sheets[j])
+            sheets = [sheet for j, sheet in enumerate(sheets) if j not in extra]
+
+        wanted = set(self.sheet_titles)
         for i in range(len(self.sheet_titles)):
-            if self.sheet_titles[i] in [sheet.title for sheet in sheets]:
-                self.spreadsheet.worksheet(self.sheet_titles[i]).update_index(i)
+            if sheets[i].title == self.sheet_titles[i]:
+                continue
+            titles = [sheet.title for sheet in sheets]
+            if self.sheet_titles[i] in titles:
+                index = titles.index(self.sheet_titles[i])
             else:
-                sheets[i].update_title(self.sheet_titles[i])
+                # листа страницы нет - переименовываем лишний лист, а не лист другой страницы;
+                # на нем нет содержимого этой страницы
+                index = next((j for j in range(i, len(sheets)) if sheets[j].title not in wanted), i)
+                self.limiter.call(sheets[index].update_title, self.sheet_titles[i])
+                self._replaced.add(i)
+            if index != i:
+                sheet = sheets.pop(index)
+                self.limiter.call(sheet.update_index, i)
+                sheets.insert(i, sheet)
+        return sheets
+
+    def _refresh_metadata(self):
+        """Сверяет листы с таблицей и обновляет кэш метаданных."""
+        self._sheet_ids = [sheet.id for sheet in self._check_worksheets()]
+        self._metadata_checked = True
+        SpreadsheetMetadata(self.spreadsheet.id, list(zip(self._sheet_ids, self.sheet_titles)),
+                            self.title).save(self._metadata_path)
+        RunStats().set_sheet_titles(self.spreadsheet.id, self.title, dict(zip(self._sheet_ids, self.sheet_titles)))
+
+    def is_replaced(self, sheet_index) -> bool:
+        return sheet_index in self._replaced
+
+    def get_replaced(self) -> set:
+        """Страницы, чей лист создан или переименован при сверке с таблицей и еще не записан целиком:
+        точечные правки и время им не помогут, такие листы надо перезаписать."""
+        with self._metadata_lock:
+            return set(self._replaced)
 
     def update_sheet(self, sheet_index, header_dict, update, formats):
-        sheet = self.spreadsheet.get_worksheet(sheet_index)
-        sheet.delete_columns(1, 8)
-        sheet.add_cols(0)
-        sheet.freeze(rows=3)
-        sheet.batch_update(header_dict['batch_update'])
-        set_column_widths(sheet, header_dict['set_column_widths'])
-        set_row_heights(sheet, header_dict['set_row_heights'])
-        format_cell_ranges(sheet, header_dict['format_cell_ranges'])
+        """Ставит в очередь полную перезапись листа. Отправка - в send()."""
+        sheet_id = self._sheet_ids[sheet_index]
+        requests = self._requests[sheet_index]
+        self._rewrites.add(sheet_index)
+        requests.clear_columns(sheet_id, 8)
+        row_count = len(header_dict['batch_update']) + sum(len(el['values']) for el in update)
+        requests.set_grid(sheet_id, max(SHEET_ROW_COUNT, row_count), 3)
+        for el in header_dict['batch_update']:
+            requests.set_values(sheet_id, el['range'], el['values'])
+        requests.set_dimension_sizes(sheet_id, header_dict['set_column_widths'])
+        requests.set_dimension_sizes(sheet_id, header_dict['set_row_heights'])
+        requests.format_ranges(sheet_id, header_dict['format_cell_ranges'])
         for el in header_dict['merge_cells_iterate']:
-            sheet.merge_cells(el)
-        sheet.batch_update(update)
-        if len(formats) > 0:
-            format_cell_ranges(sheet, formats)
+            requests.merge(sheet_id, el)
+        for el in update:
+            requests.set_values(sheet_id, el['range'], el['values'])
+        requests.format_ranges(sheet_id, formats)
+
+    def update_rows(self, sheet_index, update):
+        """Ставит в очередь точечное обновление изменившихся рядов, не трогая структуру и оформление листа"""
+        sheet_id = self._sheet_ids[sheet_index]
+        for el in update:
+            self._requests[sheet_index].set_values(sheet_id, el['range'], el['values'])
+
+    def send(self, sheet_index) -> int:
+        """Отправляет накопленные изменения одного листа, возвращает количество вызовов API.
+        Разные листы можно отправлять из разных потоков."""
+        requests = self._requests[sheet_index]
+        rewrite = sheet_index in self._rewrites
+        try:
+            calls = requests.execute()
+        except gspread.exceptions.APIError as error:
+            if error.response.status_code != 400:
+                raise
+            # возможно, id листа из кэша устарел - сверяемся с таблицей и, если id другой, отправляем заново
+            with self._metadata_lock:
+                if not self._metadata_checked:
+                    logging.getLogger(__name__).warning("Sheets API rejected a request, refreshing sheet metadata.")
+                    self._refresh_metadata()
+            if requests.get_sheet_ids() == {self._sheet_ids[sheet_index]}:
+                raise
+            if not rewrite and self.is_replaced(sheet_index):
+                # на пересозданный лист точечные правки не шлем: без шапки и остальных рядов он так и останется пустым
+                logging.getLogger(__name__).warning(f"Sheet {self.sheet_titles[sheet_index]} was recreated, "
+                                                    f"it needs a full rewrite.")
+                requests.clear()
+                return 0
+            requests.retarget(self._sheet_ids[sheet_index])
+            calls = requests.execute()
+        if rewrite:
+            with self._metadata_lock:
+                self._rewrites.discard(sheet_index)
+                self._replaced.discard(sheet_index)
+        return calls
+
+    def discard(self):
+        """Отбрасывает неотправленные изменения всех листов."""
+        for requests in self._requests:
+            requests.clear()
+        self._rewrites.clear()
 
     def update_time(self):
-        """Обновляем только время последнего обновления в ячейке B1 на каждой странице"""
+        """Обновляем только время последнего обновления в ячейке B1 на каждой странице - одним запросом на все листы"""
         dt = f"Последнее обновление: {datetime.now().strftime('%H:%M %d/%m')}"
-        for sheet_index in range(len(self.sheet_titles)):
-            sheet = self.spreadsheet.get_worksheet(sheet_index)
-            sheet.batch_update([{
-                'range' : 'B1',
-                'values' : [[dt]]
-            }])
-            time.sleep(2)
+        body = {'valueInputOption': 'RAW',
+                'data': [{'range': absolute_range_name(title, 'B1'), 'values': [[dt]]} for title in self.sheet_titles]}
+        try:
+            self.limiter.call(self.spreadsheet.values_batch_update, body=body)
+        except gspread.exceptions.APIError as error:
+            # листа с таким названием нет - если листы брались из кэша, сверяемся с таблицей и повторяем
+            if error.response.status_code != 400 or self._metadata_checked:
+                raise
+            logging.getLogger(__name__).warning("Sheets API rejected the time update, refreshing sheet metadata.")
+            with self._metadata_lock:
+                self._refresh_metadata()
+            self.limiter.call(self.spreadsheet.values_batch_update, body=body)
 
 
 class Item:
-    """Товар из прайса. Содержит название, остаток и цены на товар, принадлежность к какой-либо странице прайса."""
-
-    def __init__(self, item_row):
-        self._properties = {'page': []}
-        self._make_item(item_row)
-        self.get_item()
-
-    def _make_item(self, item_row):
-        cols = Header().get_col_headers()  # тянем список названий колонок
-        for i in range(len(item_row)):  # бежим по ячейкам ряда
-            if item_row[i].value is None:  # если ячейка пустая, пропуск
-                continue
-            self._properties[cols[i + 1]] = item_row[i].value  # привязываем значение ячейки к названию столбца
-        keywords = Header().get_keywords()  # тянем список названий страниц
-        # Если в названии товара содержится ключевое слово из названия страницы - добавляем принадлежность этой странице
-        for i in range(len(keywords)):
-            if any(brand_name.lower() in self._properties['Номенклатура'].lower() for brand_name in keywords[i]):
-                self._properties['page'].append(i)
-        if len(self._properties['page']) == 0:
-            # если ни одного слова не совпало - добавляем на последнюю страницу
-            self._properties['page'].append(len(keywords) - 1)
+    """Товар из прайса. Содержит название, остаток и цены на товар, принадлежность к какой-либо странице прайса.
+    Значения хранятся кортежем в порядке колонок заголовка, позиции колонок - общий на весь прайс dict из Header."""
+    __slots__ = ('_positions', '_values', 'page_mask')
+
+    def __init__(self, item_row, header: Header, page_mask=None):
+        """header - Header прайса с разобранными колонками.
+        page_mask - маска страниц, если товар уже классифицирован пачкой. Если None - классифицируем сами."""
+        self._positions = header.get_col_positions()
+        self._values = tuple(item_row.get(column) for column in header.get_col_headers())
+        self.page_mask = 0  # бит N выставлен, если товар попадает на страницу N
+        if page_mask is None:
+            # Если в названии товара содержится ключевое слово из названия страницы - добавляем принадлежность этой странице
+            page_mask = header.get_matcher().classify(self.get('Номенклатура'))
+        self.set_page_mask(page_mask)
+
+    def set_page_mask(self, page_mask: int):
+        self.page_mask = page_mask
+
+    def get(self, col_name):
+        position = self._positions.get(col_name)
+        return None if position is None else self._values[position]
+
+    def get_row(self, cols: list) -> list:
+        """Значения товара для колонок cols, None если такой колонки нет"""
+        positions = self._positions
+        values = self._values
+        return [values[positions[col_name]] if col_name in positions else None for col_name in cols]
+
+    def get_pages(self) -> list:
+        return [i for i in range(self.page_mask.bit_length()) if self.page_mask >> i & 1]
+
+    @classmethod
+    def from_values(cls, values: tuple, positions: dict, page_mask: int):
+        """Товар из уже разобранных значений, например из снимка прайса. Header при этом не нужен."""
+        item = cls.__new__(cls)
+        item._positions = positions
+        item._values = values
+        item.page_mask = page_mask
+        return item
+
+    def get_values(self) -> tuple:
+        return self._values
 
     def get_item(self):
         return self
 
     def get_item_props(self) -> dict:
-        """возвращает dict вида: {
+        """собирает и возвращает dict вида: {
         'Наименование' : 'что-то',
         'Остаток' : int,
         'Какой-то вид цены' : int,
         'page' : list[int*]
         }"""
-        return self._properties
+        props = {'page': self.get_pages()}
+        for col_name, position in self._positions.items():
+            if self._values[position] is not None:
+                props[col_name] = self._values[position]
+        return props
 
 
 class ItemGroup(object):
     """Группа, в которой содержится папка из прайса. Может содержать под-группы и товары.
-    Содержит имя группы и ссылки на родительский и дочерние эл-ты."""
+    Содержит имя группы, ссылки на родительский и дочерние эл-ты и маску страниц, на которые попадают ее товары."""
+    __slots__ = ('parent', 'header_row', 'children_list', 'page_mask')
 
     def __init__(self):
         self.parent = None
         self.header_row = None
         self.children_list = []
+        self.page_mask = 0
 
     def __iter__(self):
         return iter(self.children_list)
@@ -230,195 +1099,421 @@ class ItemGroup(object):
     def __len__(self):
         return len(self.children_list)
 
-    def remove_element(self, element):
-        self.children_list = [el for el in self.children_list if el is not element]
-
     def set_parent(self, new_parent):
         self.parent = new_parent
 
-    def set_header(self, header_row):
-        self.header_row = header_row[0].value
+    def set_header(self, header_row: dict):
+        self.header_row = header_row.get(1)
 
     def get_header(self):
         return self.header_row
 
+    @classmethod
+    def from_rows(cls, header: Header, header_row: dict, rows):
+        """Строит дерево групп за один проход по рядам вида tuple(номер ряда, уровень группировки, значения).
+        Ряд - заголовок группы, если следующий за ним ряд вложен глубже, иначе это товар.
+        Открытые группы хранятся в стеке, поэтому глубина вложенности не упирается в рекурсию.
+        header - Header прайса: колонки для товаров и ключевые слова страниц."""
+        matcher = header.get_matcher()
+        root = cls()
+        root.set_header(header_row)
+        stack = [(-1, root)]  # tuple(уровень группировки, группа)
+        unclassified = []  # tuple(группа, товар), страницы которых проставим пачкой
+
+        def classify():
+            names = [item.get('Номенклатура') for _, item in unclassified]
+            for (group, item), page_mask in zip(unclassified, matcher.classify_many(names)):
+                item.set_page_mask(page_mask)
+                group.add_page_mask(page_mask)
+            unclassified.clear()
+
+        pending = None
+        for row in itertools.chain(rows, [None]):
+            if pending is not None:
+                level, values = pending
+                while stack[-1][0] >= level:
+                    stack.pop()
+                parent = stack[-1][1]
+                if row is not None and row[1] > level:
+                    group = cls()
+                    group.set_parent(parent)
+                    group.set_header(values)
+                    parent.add_child(group)
+                    stack.append((level, group))
+                else:
+                    item = Item(values, header, page_mask=0)
+                    parent.add_child(item)
+                    unclassified.append((parent, item))
+                    if len(unclassified) >= CLASSIFY_BATCH:
+                        classify()
+            pending = None if row is None else (row[1], row[2])
+        classify()
+        return root
+
     def add_child(self, child):
-        if type(child) == tuple:
-            # создаем экземпляр Item
-            self.children_list.append(Item(child))
-        else:
-            self.children_list.append(child)
+        self.children_list.append(child)
+        self.add_page_mask(child.page_mask)
 
-    def move_children_to_parent(self):
-        """Передаем все дочерние эл-ты родителю, обнуляем список дочерних эл-тов"""
-        for child in self.children_list:
-            self.parent.add_child(child)
-        self.children_list = []
+    def add_page_mask(self, page_mask: int):
+        """Поднимаем маску страниц вверх по родителям, пока она что-то добавляет"""
+        group = self
+        while group is not None and group.page_mask | page_mask != group.page_mask:
+            group.page_mask |= page_mask
+            group = group.parent
+
+
+class PageGroupView:
+    """Группа в том виде, в каком она видна на странице: без копирования, только фильтр по биту страницы.
+    Товары других страниц и группы, в которых нет товаров страницы, пропускаются.
+    Если raise_children - дочерние группы, в которых на странице всего одна подгруппа,
+    показывают содержимое этой подгруппы вместо нее."""
+
+    __slots__ = ('_header', '_source', '_page_bit', '_raise_children')
+
+    def __init__(self, header, source: ItemGroup, page_bit: int, raise_children=False):
+        self._header = header
+        self._source = source
+        self._page_bit = page_bit
+        self._raise_children = raise_children
 
-    def raiser(self):
-        """Проверяет входящие группы, и если в этих группах всего 1 элемент,
-        который тоже является группой - забираем из него детей и перекладываем в группу выше"""
-        elements_to_remove = []
-        # бежим по дочерним элементам группы
-        for element in self.children_list:
-            if type(element) == Item:
+    def __iter__(self):
+        for child in self._source:
+            if not child.page_mask & self._page_bit:
                 continue
-            if len(element) == 0:
-                elements_to_remove.append(element)
-            if len(element) == 1:
-                # если содержит только 1 child и это группа - запускаем в ней raiser
-                if type(element.children_list[0]) == ItemGroup:
-                    element.children_list[0].raiser()
-                    # запускаем передачу эл-тов в родительскую группу
-                    element.children_list[0].move_children_to_parent()
-                    elements_to_remove.append(element.children_list[0])
-            for el in elements_to_remove:
-                element.remove_element(el)
+            if type(child) == Item:
+                yield child
+            elif self._raise_children:
+                yield self._raised(child)
+            else:
+                yield PageGroupView(child.get_header(), child, self._page_bit)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def _raised(self, group: ItemGroup):
+        visible = []
+        for child in group:
+            if child.page_mask & self._page_bit:
+                visible.append(child)
+                if len(visible) > 1:
+                    break
+        if len(visible) == 1 and type(visible[0]) == ItemGroup:
+            # заголовок остается от внешней группы, содержимое берем из единственной подгруппы
+            return PageGroupView(group.get_header(), visible[0], self._page_bit, raise_children=True)
+        return PageGroupView(group.get_header(), group, self._page_bit)
+
+    def get_header(self):
+        return self._header
 
 
 class PriceListPage:
-    """Содержит заголовок страницы и группы с товарами, которые попадают на эту страницу.
-    Принимает КОПИЮ групп. После получения просеивает группы, оставляя только те что должны попасть на страницу."""
+    """Содержит заголовок страницы и представление общего дерева групп с товарами, которые попадают на эту страницу.
+    Дерево не копируется: страница отбирает товары и группы по своему биту в page_mask."""
 
     def __init__(self, page_index: int, page_name: list, groups: ItemGroup):
         self._index = page_index
         self.name = "\\".join(page_name)
         self._groups = groups
-        self.sift_groups()
-
-    def sift_groups(self):
-        def sieve(group: ItemGroup):
-            """Сито, которое отсеивает неподходящие элементы и пустые группы"""
-            elements_to_remove = []
-            for item in group:
-                if type(item) == Item:
-                    # если Item не принадлежит этой странице, добавляем в список на удаление
-                    if self._index not in item.get_item_props()['page']:
-                        elements_to_remove.append(item)
-                # Если элемент - вложенная группа, ее тоже загоняем в сито.
-                elif type(item) == ItemGroup:
-                    # добавляем в список на удаление если группа возвращается, если не удаляется то возвращается None
-                    elements_to_remove.append(sieve(item))
-                else:
-                    raise TypeError(f"Member of group cannot be {type(item)}!")
-            for el in elements_to_remove:
-                if el is not None:
-                    group.remove_element(el)
-            # возвращаем группу, если она опустела.
-            if len(group) == 0:
-                return group
-            else:
-                return None
 
-        sieve(self._groups)
-        self._groups.raiser()
+    def get_content(self) -> PageGroupView:
+        return PageGroupView(self._groups.get_header(), self._groups, 1 << self._index, raise_children=True)
+
+
+class PriceListDiff:
+    """Сравнивает старый и новый прайс по товарам. Ключ товара - путь из заголовков групп и Номенклатура.
+    Определяет страницы, которые затронули изменения. Позиция товара - номера в группе его самого и всех его групп,
+    поэтому переставленные группы тоже считаются изменением; какие ряды сдвинулись, решает сравнение рядов страницы."""
 
-    def get_content(self):
+    def __init__(self, old_groups: ItemGroup, new_groups: ItemGroup):
+        old_items = self._index(old_groups)
+        new_items = self._index(new_groups)
+        self.changed_pages = set()
+        for key in old_items.keys() | new_items.keys():
+            old, new = old_items.get(key), new_items.get(key)
+            if old == new:
+                continue
+            # товар добавился, пропал, поменялся или сдвинулся - затронуты его страницы в обеих версиях
+            for entry in (old, new):
+                if entry is not None:
+                    self.changed_pages.update(entry[1]['page'])
+
+    @staticmethod
+    def _index(groups: ItemGroup) -> dict:
+        """Возвращает dict вида {(путь групп, Номенклатура, номер повтора): (позиция в дереве, свойства товара)}"""
+        result = {}
+
+        def walk(group: ItemGroup, path: tuple, indexes: tuple):
+            for index, element in enumerate(group):
+                position = indexes + (index,)
+                if type(element) == ItemGroup:
+                    walk(element, path + (element.get_header(),), position)
+                    continue
+                props = element.get_item_props()
+                key = (path, props.get('Номенклатура'), 0)
+                # одинаковые названия в одной группе различаем по номеру повтора
+                while key in result:
+                    key = (path, key[1], key[2] + 1)
+                result[key] = (position, props)
+
+        walk(groups, (), ())
+        return result
+
+
+class PriceSnapshot:
+    """Разобранная версия прайса из SnapshotStore: дерево групп с проставленными страницами и колонки страниц."""
+
+    def __init__(self, snapshot_id: int, taken: str, groups: ItemGroup, cols: list):
+        self.id = snapshot_id
+        self.taken = taken
+        self._groups = groups
+        self._cols = cols
+
+    def get_groups(self) -> ItemGroup:
         return self._groups
 
+    def get_cols(self) -> list:
+        return self._cols
+
+
+class SnapshotStore:
+    """Снимки разобранного прайса в SQLite: дерево групп и товаров в порядке обхода, маски страниц, значения товаров.
+    Последний снимок загружается без XLSX для сравнения со следующей версией, хранятся последние retention снимков,
+    по ним же строится история цен товара."""
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS snapshots (
+            id INTEGER PRIMARY KEY,
+            taken TEXT NOT NULL,
+            keywords TEXT NOT NULL,  -- JSON, ключевые слова страниц, по которым проставлены маски
+            columns TEXT NOT NULL,   -- JSON, названия колонок в порядке значений товара
+            cols TEXT NOT NULL,      -- JSON, колонки страниц
+            root_header TEXT
+        );
+        CREATE TABLE IF NOT EXISTS nodes (
+            snapshot_id INTEGER NOT NULL REFERENCES snapshots(id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,  -- порядок обхода дерева
+            depth INTEGER NOT NULL,
+            is_group INTEGER NOT NULL,
+            name TEXT,
+            page_mask INTEGER NOT NULL,
+            item_values TEXT,  -- JSON, значения товара; у групп NULL
+            PRIMARY KEY (snapshot_id, position)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS nodes_name ON nodes (name, snapshot_id);
+    """
+
+    def __init__(self, path=SNAPSHOT_DB, retention=SNAPSHOT_RETENTION):
+        self._retention = retention
+        # задание обновляется в потоках пула, поэтому соединение не привязано к потоку, а обращения идут под замком
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(f'PRAGMA mmap_size = {SNAPSHOT_MMAP_SIZE}')
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        self._connection.execute('PRAGMA foreign_keys = ON')
+        self._connection.executescript(self._SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    @staticmethod
+    def _walk(groups: ItemGroup):
+        """Обход дерева в глубину: tuple(глубина, группа или товар). Корень не входит."""
+        stack = [(0, iter(groups))]
+        while stack:
+            depth, children = stack[-1]
+            element = next(children, None)
+            if element is None:
+                stack.pop()
+                continue
+            yield depth, element
+            if type(element) == ItemGroup:
+                stack.append((depth + 1, iter(element)))
+
+    def save(self, price_list) -> int:
+        """Сохраняет разобранный прайс и удаляет снимки сверх retention. Возвращает id снимка."""
+        groups = price_list.get_groups()
+        columns = price_list.get_columns()
+        with self._lock, self._connection:
+            snapshot_id = self._connection.execute(
+                'INSERT INTO snapshots (taken, keywords, columns, cols, root_header) VALUES (?, ?, ?, ?, ?)',
+                (datetime.now().isoformat(timespec='seconds'), json.dumps(price_list.get_keywords(), ensure_ascii=False),
+                 json.dumps(columns, ensure_ascii=False), json.dumps(price_list.get_cols(), ensure_ascii=False),
+                 groups.get_header())).lastrowid
+            name_position = columns.index('Номенклатура') if 'Номенклатура' in columns else None
+            self._connection.executemany(
+                'INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ((snapshot_id, position, depth, 1, element.get_header(), 0, None)
+                 if type(element) == ItemGroup else
+                 (snapshot_id, position, depth, 0,
+                  None if name_position is None else element.get_values()[name_position],
+                  element.page_mask, json.dumps(element.get_values(), ensure_ascii=False))
+                 for position, (depth, element) in enumerate(self._walk(groups))))
+            self._connection.execute(
+                'DELETE FROM snapshots WHERE id NOT IN (SELECT id FROM snapshots ORDER BY id DESC LIMIT ?)',
+                (self._retention,))
+        return snapshot_id
+
+    def latest(self, keywords: list):
+        """Последний снимок как PriceSnapshot. None, если снимков нет или он снят для других ключевых слов страниц."""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT id, taken, keywords, columns, cols, root_header FROM snapshots ORDER BY id DESC LIMIT 1'
+            ).fetchone()
+        if row is None:
+            return None
+        snapshot_id, taken, snapshot_keywords, columns, cols, root_header = row
+        if json.loads(snapshot_keywords) != keywords:
+            return None  # маски страниц проставлены по другим ключевым словам
+        positions = {name: position for position, name in enumerate(json.loads(columns))}
+        root = ItemGroup()
+        root.set_header({1: root_header})
+        stack = [root]
+        with self._lock:
+            nodes = self._connection.execute(
+                'SELECT depth, is_group, name, page_mask, item_values FROM nodes WHERE snapshot_id = ? ORDER BY position',
+                (snapshot_id,)).fetchall()
+        # значения всех товаров разбираем одним вызовом json - по товару выходит в разы дольше
+        values = iter(json.loads('[' + ','.join(node[4] for node in nodes if not node[1]) + ']'))
+        for depth, is_group, name, page_mask, _ in nodes:
+            del stack[depth + 1:]
+            if is_group:
+                group = ItemGroup()
+                group.set_parent(stack[-1])
+                group.set_header({1: name})
+                stack[-1].add_child(group)
+                stack.append(group)
+            else:
+                stack[-1].add_child(Item.from_values(tuple(next(values)), positions, page_mask))
+        return PriceSnapshot(snapshot_id, taken, root, json.loads(cols))
+
+    def price_history(self, name: str) -> list:
+        """История товара по названию (Номенклатура) во всех хранящихся снимках, от старых к новым:
+        [(время снимка, {колонка: значение})]. Одинаковые названия из разных групп идут отдельными записями."""
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT snapshots.taken, snapshots.columns, nodes.item_values FROM nodes '
+                'JOIN snapshots ON snapshots.id = nodes.snapshot_id '
+                'WHERE nodes.name = ? AND nodes.is_group = 0 ORDER BY nodes.snapshot_id, nodes.position',
+                (name,)).fetchall()
+        return [(taken, dict(zip(json.loads(columns), json.loads(item_values))))
+                for taken, columns, item_values in rows]
+
 
-@singleton
 class PriceList:
     """Корневой класс. Содержит заголовок, список ключевых слов для генерации страниц прайса,
     список групп, страницы прайса, позже добавлю еще что-нибудь."""
 
-    def __init__(self, log_machine, link_to_file=None):
+    def __init__(self, log_machine, link_to_file=None, previous_file=None, previous=None, header=None):
+        """link_to_file - файл прайса или уже прочитанные iter_xlsx_rows ряды (один прайс на несколько заданий).
+        previous_file - файл прошлого прайса, previous - уже разобранная прошлая версия:
+        PriceList из памяти (режим --daemon) или PriceSnapshot. По ним определяется, какие страницы и ряды изменились.
+        header - Header задания: страницы и контакты, по умолчанию наши."""
         self._logger = log_machine
-        self._worksheet = openpyxl.load_workbook(link_to_file).active
-        self._header = Header().parse_header(self._worksheet[1], self._worksheet[2])
-        self._groups = self._parse_groups()
-        self._sheet_keywords = Header().get_keywords()
-        self._item_pages = self._create_pages()
-        self._editor = GoogleSpreadsheetEditor()
-        self.send_pages()
-        self._logger.info("Finished.")
+        self._header = header if header is not None else Header()
+        self._sheet_keywords = self._header.get_keywords()
+        # предыдущий прайс разбираем первым, т.к. Item берет названия колонок из текущего заголовка
+        previous_groups, previous_cols = None, None
+        if previous is not None:
+            previous_groups, previous_cols = previous.get_groups(), previous.get_cols()
+        elif previous_file is not None:
+            with RunStats().stage('parse previous'):
+                previous_groups = self._parse_groups(previous_file)
+            previous_cols = self._header.get_col_headers_cleaned()
+        with RunStats().stage('parse'):
+            self._groups = self._parse_groups(link_to_file)
+        self._cols = self._header.get_col_headers_cleaned()
+        self._columns = list(self._header.get_col_headers().values())  # порядок значений в Item
+        with RunStats().stage('pages'):
+            self._item_pages = self._create_pages(self._groups)
+        # если колонки не поменялись - отправляем только затронутые изменениями страницы
+        self._previous_pages = None
+        if previous_groups is not None and previous_cols == self._cols:
+            with RunStats().stage('diff'):
+                changed_pages = PriceListDiff(previous_groups, self._groups).changed_pages
+            self._logger.info(f"Pages affected by changes: {len(changed_pages)}.")
+            self._previous_pages = dict(zip(sorted(changed_pages),
+                                            self._create_pages(previous_groups, sorted(changed_pages))))
+        self._editor = None
+
+    def get_groups(self) -> ItemGroup:
+        return self._groups
 
-    def _parse_groups(self) -> ItemGroup:
-        """Запускает поиск групп в документе. Возвращает список групп."""
+    def get_cols(self) -> list:
+        return self._cols
 
-        def cleanup(x: list):
-            """Обрабатывает результат работы splitter.
-            Превращает все tuple в многомерном списке в одиночные элементы с номером ряда"""
-            result = []
-            for i in x:
-                if type(i) is list:
-                    result.append(cleanup(i))
-                else:
-                    result.append(i[1])
-            return result
+    def get_columns(self) -> list:
+        return self._columns
 
-        def splitter(x: list, base=0):
-            """Обрабатывает список, состоящий из tuple(уровень ряда, номер ряда).
-            Возвращает многоуровневый список групп вида [название группы, [элемент группы, элемент группы...]]"""
-            result = []
-            if x[0][0] < base:
-                result.append(x[0])
-            if len(set([a[0] for a in x[1:]])) == 1:
-                result.append(x[1:])
-                return result
-            for i in range(len(x)):
-                if x[i][0] == base:
-                    for y in range(i + 1, len(x)):
-                        if x[y][0] == base:
-                            result.append(splitter(x[i:y], base + 1))
-                            break
-                    else:
-                        result.append(splitter(x[i:], base + 1))
-            return result
-
-        # собираем список рядов в виде tuple(уровень_ряда, номер_ряда)
-        self._logger.info("Pulling groups and items from price list...")
-        outline_levels = []
-        for row in range(3, self._worksheet.max_row + 1):
-            outline_levels.append((self._worksheet.row_dimensions[row].outline_level, row))
-        groups = cleanup(splitter(outline_levels))
-        groups.insert(0, 1)
-        return self._group_maker(groups)
-
-    def _group_maker(self, row_list: list, parent=None) -> ItemGroup:
-        """Конструктор групп, умеет в рекурсию.
-        Обрабатывает список вида [название группы, [элемент группы, элемент группы...]]"""
-        new_group = ItemGroup()
-        if parent is not None:
-            new_group.set_parent(parent)
-        for row in range(len(row_list)):
-            if row == 0:
-                new_group.set_header(self._worksheet[row_list[row]])
-                continue
-            # если внутри списка элементов есть еще хоть один список - значит этот список тоже группа
-            if any(type(x) == list for x in row_list[row]):
-                # вторым аргументом отправляется родительский элемент
-                new_group.add_child(self._group_maker(row_list[row], new_group))
-            else:
-                for item in row_list[row]:
-                    new_group.add_child(self._worksheet[item])  # конструктор add_child возвращает Item
-        return new_group
+    def get_keywords(self) -> list:
+        return self._sheet_keywords
 
-    def _create_pages(self):
+    def _parse_groups(self, file_data) -> ItemGroup:
+        """Читает прайс за один проход: сначала заголовок из первых двух рядов, затем дерево групп.
+        Возвращает корневую группу."""
+        self._logger.info("Pulling groups and items from price list...")
+        rows = iter_xlsx_rows(file_data) if hasattr(file_data, 'read') else iter(file_data)
+        header_rows = {}
+        for row in rows:
+            if row[0] >= 3:
+                # первый ряд прайса возвращаем в начало потока
+                rows = itertools.chain([row], rows)
+                break
+            header_rows[row[0]] = row[2]
+        self._header.parse_header(header_rows.get(1, {}), header_rows.get(2, {}))
+        return ItemGroup.from_rows(self._header, header_rows.get(1, {}), rows)
+
+    def _create_pages(self, groups: ItemGroup, page_indexes=None):
         self._logger.info("Distributing groups and items to sheets...")
+        if page_indexes is None:
+            page_indexes = range(len(self._sheet_keywords))
         item_pages = []
-        for i in range(len(self._sheet_keywords)):
-            item_pages.append(PriceListPage(i, self._sheet_keywords[i], deepcopy(self._groups)))
+        for i in page_indexes:
+            item_pages.append(PriceListPage(i, self._sheet_keywords[i], groups))
         return item_pages
 
-    def send_pages(self):
-        def compose_items(group: ItemGroup, cols: list) -> list:
+    @classmethod
+    def _compose_items(cls, group: PageGroupView, cols: list, result=None) -> list:
+        """Ряды страницы по порядку: заголовок группы - ряд из одной ячейки, товар - значения колонок cols"""
+        if result is None:
             result = []
-            for item in group:
-                if type(item) == ItemGroup:
-                    result.append([item.get_header()])
-                    result += compose_items(item, cols)
-                elif type(item) == Item:
-                    row = []
-                    props = item.get_item_props()
-                    for col_name in cols:
-                        if col_name in props:
-                            row.append(props[col_name])
-                        else:
-                            row.append(None)
-                    result.append(row)
-            return result
+        for item in group:
+            if type(item) == PageGroupView:
+                result.append([item.get_header()])
+                cls._compose_items(item, cols, result)
+            elif type(item) == Item:
+                result.append(item.get_row(cols))
+        return result
+
+    @staticmethod
+    def _row_runs(row_indexes) -> list:
+        """Разбивает возрастающие индексы рядов на непрерывные отрезки [(первый, последний), ...]"""
+        runs = []
+        for y in row_indexes:
+            if runs and runs[-1][1] == y - 1:
+                runs[-1][1] = y
+            else:
+                runs.append([y, y])
+        return [tuple(run) for run in runs]
 
+    @staticmethod
+    def _diff_rows(old_rows: list, new_rows: list):
+        """Сравнивает ряды страницы. Если раскладка (кол-во рядов и позиции заголовков групп) та же,
+        возвращает индексы изменившихся рядов. Если раскладка поменялась - возвращает None."""
+        if len(old_rows) != len(new_rows):
+            return None
+        changed = []
+        for y in range(len(new_rows)):
+            if (len(old_rows[y]) == 1) != (len(new_rows[y]) == 1):
+                return None
+            if old_rows[y] != new_rows[y]:
+                changed.append(y)
+        return changed
+
+    def send_pages(self, editor, journal=None, upload_workers=UPLOAD_WORKERS, uploaders=None, stage_prefix=''):
+        """Собирает страницы и отправляет их в таблицу editor, до upload_workers листов одновременно.
+        uploaders - общий пул отправки, если таблиц несколько: тогда листы всех таблиц отправляются вместе.
+        journal - UploadJournal этой версии: записанные листы пропускаются, каждый отправленный лист отмечается.
+        stage_prefix - приставка к этапам листов в RunStats, чтобы одноименные листы разных заданий не складывались."""
+        self._editor = editor
         # секция, в которой генерируется шапка, одинаковая на каждой странице
         # В словаре header_dict содержатся: содержимое ячеек(batch_update),
         # ширина и высота столбцов/строк(set_column_widths, set_row_heights),
@@ -469,55 +1564,390 @@ class PriceList:
         # item_row_style = CellFormat(backgroundColor=Color(1, 1, 0),  # yellow
         #                             textFormat=TextFormat(bold=False),
         #                             horizontalAlignment='LEFT', verticalAlignment='MIDDLE')
-        self._logger.info("Sending sheets to project with 10s timeout to prevent API overload.")
-        for i in range(len(self._item_pages)):  # цикл по страницам
-            batch_update = []
-            cell_formats = []
-            rows = compose_items(self._item_pages[i].get_content(), col_names)
-            for y in range(len(rows)):  # цикл по рядам
-                if len(rows[y]) == 1:  # если 1 ячейка - это заголовок группы
-                    batch_update.append({'range': f'A{len(header_dict["batch_update"]) + y + 1}',
-                                         'values': [[rows[y][0]]]})
-                    cell_formats.append((
-                        f'A{len(header_dict["batch_update"]) + y + 1}:{"ABCDEFGH"[len(col_names) - 1]}{len(header_dict["batch_update"]) + y + 1}',
-                        group_row_style,))
-                else:  # иначе это товар
-                    batch_update.append({
-                                            'range': f'A{len(header_dict["batch_update"]) + y + 1}:{"ABCDEFGH"[len(col_names) - 1]}{len(header_dict["batch_update"]) + y + 1}',
-                                            'values': [rows[y]]})
-                    # cell_formats.append((
-                    #                     f'A{len(header_dict["batch_update"]) + y + 1}:{"ABCDEFGH"[len(col_names) - 1]}{len(header_dict["batch_update"]) + y + 1}',
-                    #                     item_row_style,))
+        def compose(i):
+            if journal is not None and journal.is_done(i):
+                return False  # лист записан прошлой, оборвавшейся попыткой
+            with RunStats().stage(f"{stage_prefix}sheet {self._item_pages[i].name}"):
+                return self._queue_page(i, header_dict, col_names, group_row_style,
+                                        journal is not None and journal.is_stale(i) or self._editor.is_replaced(i))
+
+        def upload(i):
+            calls = self._editor.send(i)
+            if not calls and self._editor.is_replaced(i):
+                # лист пересоздали при сверке с таблицей, пока он ждал отправки - пишем его целиком
+                with RunStats().stage(f"{stage_prefix}sheet {self._item_pages[i].name}"):
+                    self._queue_page(i, header_dict, col_names, group_row_style, True)
+                calls = self._editor.send(i)
+            if journal is not None and calls:
+                journal.mark_done(i)
+            return calls
+
+        # листы независимы: собранный лист сразу уходит на отправку, пока собираются остальные
+        self._logger.info("Composing and sending sheets...")
+        own_uploaders = uploaders is None
+        if own_uploaders:
+            uploaders = ThreadPoolExecutor(upload_workers)
+        uploads = []
+        try:
+            with RunStats().stage('send'), ThreadPoolExecutor(COMPOSE_WORKERS) as composers:
+                composing = {composers.submit(compose, i): i for i in range(len(self._item_pages))}
+                try:
+                    for future in as_completed(composing):
+                        if future.result():
+                            uploads.append(uploaders.submit(upload, composing[future]))
+                finally:
+                    # дожидаемся всех отправок, даже если какой-то лист не собрался или не ушел: записанные должны
+                    # попасть в журнал, а на общем пуле не должно остаться отправок, когда очереди листов сбросят
+                    wait(uploads)
+                calls = sum(upload.result() for upload in uploads)
+        finally:
+            if own_uploaders:
+                uploaders.shutdown()
+        self._logger.info(f"Sheets sent in {calls} request(s).")
+        self._logger.info("Finished.")
+
+    def _queue_page(self, i, header_dict, col_names, group_row_style, full=False) -> bool:
+        """Собирает ряды страницы i и ставит ее в очередь на отправку: целиком или только изменившиеся ряды.
+        full - перезаписать лист целиком, даже если прошлая версия известна. Возвращает False, если отправлять нечего."""
+        batch_update = []
+        cell_formats = []
+        rows = self._compose_items(self._item_pages[i].get_content(), col_names)
+        row_indexes = range(len(rows))
+        partial = False
+        if self._previous_pages is not None and not full:
+            if i not in self._previous_pages:
+                return False  # товаров этой страницы изменения не коснулись
+            old_rows = self._compose_items(self._previous_pages[i].get_content(), col_names)
+            changed_rows = self._diff_rows(old_rows, rows)
+            if changed_rows is not None:
+                if len(changed_rows) == 0:
+                    return False
+                row_indexes = changed_rows
+                partial = True
+        # ряды идут сразу после шапки; заголовок группы - ряд из одной ячейки, остальные ячейки ряда не трогаем
+        top = len(header_dict['batch_update']) + 1
+        last_col = "ABCDEFGH"[len(col_names) - 1]
+        # значения - одним блоком на каждый непрерывный отрезок рядов, при полной перезаписи это один блок от A4
+        for first, last in self._row_runs(row_indexes):
+            batch_update.append({'range': f'A{top + first}:{last_col}{top + last}', 'values': rows[first:last + 1]})
+        if not partial:
+            # стоящие подряд заголовки групп оформляются одним диапазоном
+            for first, last in self._row_runs(y for y in row_indexes if len(rows[y]) == 1):
+                cell_formats.append((f'A{top + first}:{last_col}{top + last}', group_row_style))
+        if partial:
+            # раскладка страницы та же - шлем только изменившиеся ряды и время обновления
+            self._editor.update_rows(i, header_dict['batch_update'][:1] + batch_update)
+        else:
             self._editor.update_sheet(i, header_dict, batch_update, cell_formats)
-            self._logger.info(f"Sheet {self._item_pages[i].name} sent.")
-            if i + 1 != len(self._item_pages):
-                time.sleep(10)
+        self._logger.info(f"Sheet {self._item_pages[i].name} composed.")
+        return True
+
+
+class PriceJob:
+    """Задание: прайс по ссылке source, страницы по keywords с контактами contacts в шапке, таблица spreadsheet.
+    Свое состояние - снимки, журнал отправки, кэш метаданных таблицы - хранит в folder.
+    Между проверками держит в памяти разобранный прайс последней отправленной версии и редактор таблицы."""
+
+    def __init__(self, name, source=URL, spreadsheet=SPREADSHEET_TITLE, keywords=None, contacts=None, folder=FOLDER):
+        self.name = name
+        self.source = source
+        self.spreadsheet = spreadsheet
+        self.header = Header(keywords, contacts)
+        self.folder = folder
+        self._snapshots = None
+        self._editor = None
+        self._price_list = None  # PriceList последней отправленной версии
+
+    @classmethod
+    def load_all(cls, path=JOBS_FILE) -> list:
+        """Задания из jobs.json вида {"jobs": [{"name": ..., "source": ..., "spreadsheet": ...,
+        "keywords": [[...], ...], "contacts": {"phone": ..., "address": ..., "hours": ...}}]},
+        все поля кроме name необязательны. Без файла - одно наше задание, состояние в FOLDER, как раньше."""
+        if not os.path.isfile(path):
+            return [cls('default')]
+        try:
+            with open(path, 'r', encoding='utf-8') as infile:
+                entries = json.load(infile)['jobs']
+        except (ValueError, KeyError, TypeError) as error:
+            raise InvalidJob(f"{path} is not a valid jobs file: {error!r}")
+        # ошибка в одном задании не мешает остальным: его пропускаем, остальные работают
+        jobs = []
+        for number, entry in enumerate(entries if isinstance(entries, list) else [entries]):
+            try:
+                job = cls.from_config(entry)
+                if any(job.name == other.name for other in jobs):
+                    raise InvalidJob(f"duplicate job name {job.name!r}")
+            except InvalidJob as error:
+                logging.getLogger(__name__).error(f"Job #{number + 1} in {path} skipped: {error}")
+                continue
+            jobs.append(job)
+        if not jobs:
+            raise InvalidJob(f"{path} has no valid jobs")
+        return jobs
+
+    @classmethod
+    def from_config(cls, entry):
+        """Задание из одной записи jobs.json. Проверяет поля и бросает InvalidJob с понятной причиной."""
+        if not isinstance(entry, dict):
+            raise InvalidJob("job must be an object")
+        name = entry.get('name')
+        if not isinstance(name, str) or not name or name != os.path.basename(name) or name.startswith('.'):
+            raise InvalidJob(f"name must be a non-empty folder name, got {name!r}")
+        for field in ('source', 'spreadsheet'):
+            if field in entry and (not isinstance(entry[field], str) or not entry[field]):
+                raise InvalidJob(f"job {name!r}: {field} must be a non-empty string")
+        keywords = entry.get('keywords')
+        if keywords is not None:
+            if not isinstance(keywords, list) or not keywords:
+                raise InvalidJob(f"job {name!r}: keywords must be a non-empty list of pages")
+            for page in keywords:
+                if not isinstance(page, list) or not page or not all(isinstance(word, str) and word for word in page):
+                    raise InvalidJob(f"job {name!r}: every page needs a non-empty list of words, got {page!r}")
+            titles = ['\\'.join(page) for page in keywords]
+            if len(set(titles)) != len(titles):
+                raise InvalidJob(f"job {name!r}: pages must have different keywords, sheets are named after them")
+        contacts = entry.get('contacts')
+        if contacts is not None and (not isinstance(contacts, dict) or
+                                     not all(isinstance(value, str) for value in contacts.values())):
+            raise InvalidJob(f"job {name!r}: contacts must map phone/address/hours to strings")
+        folder = os.path.join(FOLDER, 'jobs', name, '')
+        os.makedirs(folder, exist_ok=True)
+        return cls(name, entry.get('source', URL), entry.get('spreadsheet', SPREADSHEET_TITLE), keywords, contacts,
+                   folder)
+
+    def _path(self, default_path) -> str:
+        """Файл состояния задания: то же имя, что у default_path, но в папке задания"""
+        return os.path.join(self.folder, os.path.basename(default_path))
+
+    def get_snapshots(self) -> SnapshotStore:
+        if self._snapshots is None:
+            self._snapshots = SnapshotStore(self._path(SNAPSHOT_DB))
+        return self._snapshots
+
+    def get_editor(self, limiter: RateLimiter) -> GoogleSpreadsheetEditor:
+        if self._editor is None:
+            self._editor = GoogleSpreadsheetEditor(self.header, limiter, metadata_path=self._path(METADATA_FILE),
+                                                   title=self.spreadsheet)
+        return self._editor
+
+    def is_interrupted(self) -> bool:
+        """Прошлая отправка в таблицу задания оборвалась"""
+        return os.path.isfile(self._path(CHECKPOINT_FILE))
+
+    def update_time(self, limiter: RateLimiter):
+        editor = self.get_editor(limiter)
+        editor.update_time()
+        self._check_replaced(editor, UploadJournal(self._path(CHECKPOINT_FILE), None))
+
+    def _check_replaced(self, editor: GoogleSpreadsheetEditor, journal: UploadJournal) -> bool:
+        """Листы, пересозданные при сверке с таблицей и не записанные целиком, отмечаются в журнале -
+        следующая проверка перезапишет их, даже если прайс не изменился. Возвращает True, если такие есть."""
+        replaced = editor.get_replaced()
+        if replaced:
+            logging.getLogger(__name__).warning(f"Job {self.name}: {len(replaced)} recreated sheet(s) "
+                                                f"will be rewritten on the next check.")
+            journal.mark_stale(replaced)
+        return bool(replaced)
+
+    def update(self, log_machine, price_data, fingerprint: str, limiter: RateLimiter, uploaders=None):
+        """Разбирает прайс для своих страниц, отправляет изменения относительно прошлой отправленной версии
+        и сохраняет снимок. price_data - файл прайса или прочитанные ряды, fingerprint - отпечаток рядов прайса.
+        Если прошлой версии нет ни в памяти, ни в снимках - таблица перезаписывается целиком."""
+        previous = self._price_list
+        if previous is None:
+            with RunStats().stage('load snapshot'):
+                previous = self.get_snapshots().latest(self.header.get_keywords())
+        price_list = PriceList(log_machine, price_data, previous=previous, header=self.header)
+        journal = UploadJournal(self._path(CHECKPOINT_FILE), fingerprint)
+        if journal.get_done():
+            log_machine.info(f"Job {self.name}: resuming upload, {len(journal.get_done())} sheet(s) already written.")
+        editor = self.get_editor(limiter)
+        try:
+            price_list.send_pages(editor, journal, uploaders=uploaders, stage_prefix=f"{self.name}: ")
+        except Exception:
+            # недоотправленные запросы не должны уйти вместе со следующей проверкой
+            editor.discard()
+            raise
+        with RunStats().stage('save snapshot'):
+            self.get_snapshots().save(price_list)
+        if not self._check_replaced(editor, journal):
+            journal.finish()
+        self._price_list = price_list
+
+
+class PriceSource:
+    """Прайс поставщика по ссылке url: за проверку скачивается и читается один раз для всех его заданий.
+    Скачанный и последний обработанный файл, отпечаток и ETag/Last-Modified хранит в folder."""
+
+    def __init__(self, url, folder=FOLDER):
+        self.url = url
+        self.saved_file = os.path.join(folder, os.path.basename(SAVED_FILE))
+        self._download_file = os.path.join(folder, os.path.basename(DOWNLOAD_FILE))
+        self._fingerprint_file = os.path.join(folder, os.path.basename(FINGERPRINT_FILE))
+        self.downloader = PriceDownloader(url, self._download_file,
+                                          os.path.join(folder, os.path.basename(VALIDATORS_FILE)))
+        self.fingerprint = FileFingerprint.load(self._fingerprint_file)
+
+    @classmethod
+    def for_url(cls, url):
+        """Наш прайс хранится в FOLDER, как раньше, остальные - каждый в своей папке sources/"""
+        if url == URL:
+            return cls(url)
+        folder = os.path.join(FOLDER, 'sources', hashlib.sha1(url.encode('utf-8')).hexdigest()[:12], '')
+        os.makedirs(folder, exist_ok=True)
+        return cls(url, folder)
+
+    def save(self, fingerprint: FileFingerprint):
+        """Все задания получили эту версию - запоминаем ее как обработанную."""
+        os.replace(self._download_file, self.saved_file)
+        fingerprint.save(self._fingerprint_file)
+        self.downloader.save_validators()
+        self.fingerprint = fingerprint
+
+
+class PriceMonitor:
+    """Проверка прайсов: скачать, сравнить с последней обработанной версией, при изменениях отправить в таблицы.
+    Каждый прайс скачивается и читается один раз на все свои задания, задания одного прайса обновляются параллельно,
+    а запросы ко всем таблицам идут через один RateLimiter и один пул отправки - квота у сервисного аккаунта общая.
+    Cron запускает одну проверку, режим --daemon - проверку раз в interval секунд; задания и прайсы между
+    проверками держат в памяти сессии, отпечатки, редакторы таблиц и прошлые версии, так что каждая следующая
+    проверка платит только за то, что изменилось."""
+
+    def __init__(self, log_machine, jobs=None, limiter=None):
+        self._logger = log_machine
+        self._jobs = jobs if jobs is not None else PriceJob.load_all()
+        self._limiter = limiter if limiter is not None else RateLimiter()
+        self._uploaders = ThreadPoolExecutor(UPLOAD_WORKERS)
+        self._sources = {}
+        for job in self._jobs:
+            if job.source not in self._sources:
+                self._sources[job.source] = PriceSource.for_url(job.source)
+
+    def _for_jobs(self, jobs: list, action, result: str) -> dict:
+        """Выполняет action(job) для всех заданий параллельно. Возвращает итог по каждому заданию:
+        result или 'failed', если задание упало - остальным это не мешает."""
+        with ThreadPoolExecutor(len(jobs)) as pool:
+            futures = {job.name: pool.submit(action, job) for job in jobs}
+        results = {}
+        for name, future in futures.items():
+            try:
+                future.result()
+                results[name] = result
+            except Exception:
+                self._logger.exception(f"Job {name} failed.")
+                results[name] = 'failed'
+        return results
+
+    def _update_time(self, jobs: list, result: str) -> dict:
+        with RunStats().stage('update time'):
+            return self._for_jobs(jobs, lambda job: job.update_time(self._limiter), result)
+
+    def check(self) -> dict:
+        """Одна проверка всех прайсов. Возвращает итог по каждому заданию для статистики.
+        Сбой одного прайса не мешает остальным."""
+        results = {}
+        for url, source in self._sources.items():
+            jobs = [job for job in self._jobs if job.source == url]
+            try:
+                results.update(self._check_source(source, jobs))
+            except Exception:
+                self._logger.exception(f"Check of {url} failed.")
+                results.update((job.name, 'failed') for job in jobs)
+        return results
+
+    def _check_source(self, source: PriceSource, jobs: list) -> dict:
+        self._logger.info(f"Obtaining file for {len(jobs)} job(s)...")
+        # прошлая отправка оборвалась - часть листов может быть записана другой версией, сверяемся в любом случае
+        interrupted = any(job.is_interrupted() for job in jobs)
+        with RunStats().stage('download'):
+            new_file_data = source.downloader.fetch(conditional=os.path.isfile(source.saved_file) and not interrupted)
+        if new_file_data is None:
+            self._logger.info("Not modified. Updating time...")
+            return self._update_time(jobs, 'not modified')
+        self._logger.info("Got it.")
+        with new_file_data:
+            if source.fingerprint is None and os.path.isfile(source.saved_file):
+                # отпечатка еще нет - снимаем его с сохраненного файла
+                with open(source.saved_file, 'rb') as saved_file:
+                    source.fingerprint = FileFingerprint.of(saved_file)
+            if source.fingerprint is not None:
+                self._logger.info("Comparing new file to old...")
+                with RunStats().stage('compare'):
+                    new_fingerprint = source.fingerprint.compare(new_file_data)
+                unchanged = new_fingerprint.rows == source.fingerprint.rows
+                if unchanged and not interrupted:
+                    # могла поменяться только упаковка - запоминаем новые байты
+                    source.save(new_fingerprint)
+                    self._logger.info("No changes. Updating time...")
+                    return self._update_time(jobs, 'unchanged')
+                self._logger.info("Previous upload was interrupted, updating." if unchanged else "Changes found, updating.")
+            else:
+                self._logger.info("Updating...")
+                new_fingerprint = FileFingerprint.of(new_file_data)
+            price_data = new_file_data
+            if len(jobs) > 1:
+                # прайс нескольких заданий читаем из XLSX один раз, деревья страниц строит каждое задание
+                with RunStats().stage('read'):
+                    price_data = list(iter_xlsx_rows(new_file_data))
+            results = self._for_jobs(jobs, lambda job: job.update(self._logger, price_data, new_fingerprint.rows,
+                                                                  self._limiter, self._uploaders), 'updated')
+        if 'failed' in results.values():
+            # файл не сохраняем - на следующей проверке он скачается заново, упавшие задания дошлют свои листы
+            self._logger.info("Update finished with failed jobs.")
+            return results
+        self._logger.info("Update finished. Saving file...")
+        source.save(new_fingerprint)
+        self._logger.info("Saved.")
+        return results
+
+    def check_and_record(self) -> dict:
+        """Проверка с записью статистики, какой бы ни был итог."""
+        results = {job.name: 'failed' for job in self._jobs}
+        try:
+            results = self.check()
+        finally:
+            RunStats().save(result=results, requests_per_minute=self._limiter.pop_counters())
+            RunStats().reset()
+        return results
+
+    def serve(self, interval=POLL_INTERVAL):
+        """Режим --daemon: проверяет прайсы каждые interval секунд. Сбой одной проверки не останавливает сервис."""
+        self._logger.info(f"Serving {len(self._jobs)} job(s), checking every {interval}s.")
+        while True:
+            started = time.monotonic()
+            try:
+                self.check_and_record()
+            except Exception:
+                self._logger.exception("Check failed, will retry on schedule.")
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Выгрузка прайса в Google Таблицу")
+    parser.add_argument('--daemon', action='store_true', help="не завершаться, проверять прайс по расписанию")
+    parser.add_argument('--interval', type=int, default=POLL_INTERVAL, help="секунд между проверками в --daemon")
+    parser.add_argument('--jobs', default=JOBS_FILE, help="файл заданий, без него - одно задание по умолчанию")
+    parser.add_argument('--history', metavar='NAME', help="вывести историю товара по сохраненным снимкам и выйти")
+    parser.add_argument('--job', help="задание для --history, по умолчанию первое")
+    args = parser.parse_args()
     log = logger()
+    try:
+        jobs = PriceJob.load_all(args.jobs)
+    except InvalidJob as error:
+        log.error(f"{error}. Shutting down.")
+        sys.exit(1)
+    if args.history is not None:
+        job = next((job for job in jobs if args.job in (None, job.name)), None)
+        if job is None:
+            parser.error(f"unknown job {args.job!r}, jobs: {', '.join(job.name for job in jobs)}")
+        for taken, values in job.get_snapshots().price_history(args.history):
+            print(taken, json.dumps(values, ensure_ascii=False))
+        sys.exit()
     log.info("============================================================")
-    log.info("Obtaining file...")
-    new_file_data = grab_url_file_to_memory(URL)
-    log.info("Got it.")
-    if os.path.isfile(FOLDER + "pricelist.xlsx"):  # проверить, существует ли файл pricelist.xlsx
-        saved_file_data = io.BytesIO(open(FOLDER + "pricelist.xlsx", 'rb').read())  # читаем существующий файл в память
-        log.info("Comparing new file to old...")
-        if xlsx_compare(new_file_data, saved_file_data):
-            GoogleSpreadsheetEditor(True)
-            log.info("No changes. Time updated. Shutting down.")
-            sys.exit()
-        else:
-            log.info("Changes found, updating.")
-            PriceList(log, new_file_data)
-            log.info("Update finished. Saving file...")
-            with open(FOLDER + "pricelist.xlsx", 'wb') as outfile:
-                outfile.write(new_file_data.getvalue())
-            log.info("Saved. Shutting down.")
+    monitor = PriceMonitor(log, jobs)
+    if args.daemon:
+        monitor.serve(args.interval)
     else:
-        log.info("Updating...")
-        PriceList(log, new_file_data)
-        log.info("Update finished. Saving file...")
-        with open(FOLDER + "pricelist.xlsx", 'wb') as outfile:
-            outfile.write(new_file_data.getvalue())
-        log.info("Saved. Shutting down.")
+        results = monitor.check_and_record()
+        log.info("Shutting down.")
+        sys.exit(1 if 'failed' in results.values() else 0)